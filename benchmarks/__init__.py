@@ -0,0 +1,12 @@
+"""
+Benchmarks of the mancify translation pipeline.
+
+Run them with ``python -m benchmarks`` from the root of the source tree. Each
+stage of the pipeline is timed separately for each dialect over the bundled
+corpora, and the results can be saved as JSON and compared with the results
+of another revision to catch regressions::
+
+    $ python -m benchmarks --output before.json
+    $ git checkout my-branch
+    $ python -m benchmarks --output after.json --compare before.json
+"""
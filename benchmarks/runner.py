@@ -0,0 +1,230 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import io
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+from timeit import default_timer as timer
+
+from mancify import translator, tagger, dialects
+from mancify.pronunciation import pronounce
+
+
+# Determine the location of the current module on the filesystem
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+CORPORA_DIR = os.path.join(HERE, 'corpora')
+
+# Corpora are split into samples by line or by paragraph (blocks separated by
+# blank lines)
+CORPORA = [
+    ('sms',   'line'),
+    ('ssh',   'paragraph'),
+    ('prose', 'paragraph'),
+    ]
+
+DIALECTS = ['manc', 'normal', 'pikachu']
+
+STAGES = ['tokenize', 'restructure', 'substitute', 'untokenize', 'pronounce']
+
+
+def load_corpus(name, split):
+    """Return the samples of the named corpus."""
+    with io.open(os.path.join(CORPORA_DIR, name + '.txt'), encoding='utf-8') as f:
+        text = f.read()
+    if split == 'line':
+        samples = text.splitlines()
+    else:
+        samples = text.split('\n\n')
+    return [sample.strip('\n') for sample in samples if sample.strip()]
+
+
+def count_words(tokens):
+    return sum(1 for token in tokens if any(c.isalnum() for c in token))
+
+
+def percentile(timings, p):
+    """Return the p-th percentile of timings by the nearest rank method."""
+    timings = sorted(timings)
+    rank = max(0, int(round(p / 100 * len(timings) + 0.5)) - 1)
+    return timings[min(rank, len(timings) - 1)]
+
+
+def time_pipeline(samples, dialect, seed, repeat):
+    """Time each stage of translating samples, returning a dict mapping stage
+    to a list of (words, seconds) tuples, one per sample per repeat."""
+    results = dict((stage, []) for stage in STAGES)
+    translator.phoneme_cache.clear()
+    for iteration in range(repeat):
+        for index, text in enumerate(samples):
+            rng = random.Random(translator.derive_seed(seed, index))
+
+            start = timer()
+            tokens = translator.tokenize(text)
+            results['tokenize'].append(timer() - start)
+            words = count_words(tokens)
+
+            start = timer()
+            restructured = translator.restructure(tokens, dialect, rng=rng)
+            results['restructure'].append(timer() - start)
+
+            start = timer()
+            translated = list(translator.substitute(restructured, dialect, rng=rng))
+            results['substitute'].append(timer() - start)
+
+            start = timer()
+            translator.untokenize(iter(translated))
+            results['untokenize'].append(timer() - start)
+
+            start = timer()
+            for token in tokens:
+                try:
+                    pronounce(token)
+                except KeyError:
+                    pass
+            results['pronounce'].append(timer() - start)
+
+            for stage in STAGES:
+                results[stage][-1] = (words, results[stage][-1])
+    return results
+
+
+def summarize(corpus, dialect, stage, timings):
+    words = sum(w for w, t in timings)
+    elapsed = sum(t for w, t in timings)
+    seconds = [t for w, t in timings]
+    return {
+        'corpus':        corpus,
+        'dialect':       dialect,
+        'stage':         stage,
+        'samples':       len(timings),
+        'words':         words,
+        'seconds':       elapsed,
+        'words_per_sec': words / elapsed if elapsed else None,
+        'p50':           percentile(seconds, 50),
+        'p99':           percentile(seconds, 99),
+        }
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=HERE, stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(corpora, dialect_names, seed, repeat):
+    translator.preload()
+    results = []
+    for corpus, split in CORPORA:
+        if corpus not in corpora:
+            continue
+        samples = load_corpus(corpus, split)
+        for name in dialect_names:
+            timings = time_pipeline(samples, dialects.get(name), seed, repeat)
+            for stage in STAGES:
+                results.append(summarize(corpus, name, stage, timings[stage]))
+    return {
+        'meta': {
+            'revision': revision(),
+            'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'tagger':   tagger.default_backend,
+            'seed':     seed,
+            'repeat':   repeat,
+            },
+        'results': results,
+        }
+
+
+def report(results, baseline=None, threshold=0.1):
+    """Print results, compared with baseline if given, and return the number
+    of results more than threshold slower than the baseline."""
+    baseline = dict(
+        ((r['corpus'], r['dialect'], r['stage']), r)
+        for r in (baseline or {'results': []})['results'])
+    regressions = 0
+    print('%-6s %-8s %-12s %12s %10s %10s %8s' % (
+        'corpus', 'dialect', 'stage', 'words/s', 'p50 ms', 'p99 ms', 'change'))
+    for r in results['results']:
+        change = ''
+        old = baseline.get((r['corpus'], r['dialect'], r['stage']))
+        if old and old['words_per_sec'] and r['words_per_sec']:
+            ratio = r['words_per_sec'] / old['words_per_sec'] - 1
+            change = '%+.1f%%' % (ratio * 100)
+            if ratio < -threshold:
+                change += ' !'
+                regressions += 1
+        print('%-6s %-8s %-12s %12.0f %10.3f %10.3f %8s' % (
+            r['corpus'], r['dialect'], r['stage'], r['words_per_sec'] or 0,
+            r['p50'] * 1000, r['p99'] * 1000, change))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stages of the mancify translation pipeline')
+    parser.add_argument(
+        '-c', '--corpus', dest='corpora', action='append',
+        choices=[name for name, split in CORPORA],
+        help='the corpus to benchmark; may be given more than once. '
+        'Default: all')
+    parser.add_argument(
+        '-d', '--dialect', dest='dialects', action='append', choices=DIALECTS,
+        help='the dialect to benchmark; may be given more than once. '
+        'Default: all')
+    parser.add_argument(
+        '-r', '--repeat', dest='repeat', action='store', default=5, type=int,
+        help='the number of times to translate each corpus. Default: %(default)s')
+    parser.add_argument(
+        '-s', '--seed', dest='seed', action='store', default=0, type=int,
+        help='the seed for translations. Default: %(default)s')
+    parser.add_argument(
+        '-t', '--tagger', dest='tagger', action='store', default=None,
+        choices=sorted(tagger.backends),
+        help='the part-of-speech tagger backend to use')
+    parser.add_argument(
+        '-o', '--output', dest='output', action='store', metavar='FILE',
+        help='save the results as JSON to FILE')
+    parser.add_argument(
+        '--compare', dest='compare', action='store', metavar='FILE',
+        help='compare the results with those saved in FILE')
+    parser.add_argument(
+        '--threshold', dest='threshold', action='store', default=10.0,
+        type=float, metavar='PERCENT',
+        help='the slow down compared with --compare results that counts as a '
+        'regression. Default: %(default)s')
+    args = parser.parse_args(args)
+    if args.tagger:
+        tagger.default_backend = args.tagger
+
+    baseline = None
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run(
+        args.corpora or [name for name, split in CORPORA],
+        args.dialects or DIALECTS, args.seed, args.repeat)
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as f:
+            f.write(str(json.dumps(results, indent=2, sort_keys=True)))
+    regressions = report(results, baseline, args.threshold / 100)
+    if regressions:
+        print('%d regression(s) of more than %.0f%%' % (regressions, args.threshold),
+            file=sys.stderr)
+        return 1
+    return 0
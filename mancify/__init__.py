@@ -43,6 +43,8 @@ __entry_points__ = {
         'mancify-curses = mancify.terminal:curses_main',
         'mancify-serve = mancify.terminal:serve_main',
         'mancify-translate = mancify.translator:main',
+        'mancify-snapshot = mancify.snapshot:main',
+        'mancify-lexicon = mancify.tagger:main',
         ],
     }
 
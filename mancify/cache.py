@@ -0,0 +1,155 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A size-bounded, thread-safe mapping which discards the least recently
+    used entries once it holds more than capacity entries.
+
+    Counts of hits, misses and evictions are kept so that the capacity can be
+    sized against real traffic. A capacity of 0 disables the cache.
+
+    """
+
+    def __init__(self, capacity=10000):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it most recently used, or default
+        if the key is not in the cache."""
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entries if
+        the cache is full."""
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.capacity > 0:
+                self.entries[key] = value
+                self._evict()
+
+    def resize(self, capacity):
+        """Change the capacity of the cache, evicting entries if it shrinks."""
+        with self.lock:
+            self.capacity = capacity
+            self._evict()
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict of the cache's size, capacity and counters."""
+        with self.lock:
+            return {
+                'size':      len(self.entries),
+                'capacity':  self.capacity,
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions,
+                }
+
+    def _evict(self):
+        while len(self.entries) > max(0, self.capacity):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+class ResultCache(LRUCache):
+    """An LRUCache of strings which also bounds the total size of its values
+    (UTF-8 encoded) to max_bytes, and forgets each entry ttl seconds after it
+    was stored.
+
+    """
+
+    def __init__(self, capacity=1000, max_bytes=1048576, ttl=3600):
+        super(ResultCache, self).__init__(capacity)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = time.time
+        self.size = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= self.clock():
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries[key] = (value, expires, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            if self.capacity > 0 and size <= self.max_bytes:
+                self.entries[key] = (value, self.clock() + self.ttl, size)
+                self.size += size
+                self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        stats = super(ResultCache, self).stats()
+        # Report the number of entries as such so it isn't confused with
+        # their size in bytes
+        stats['entries'] = stats.pop('size')
+        with self.lock:
+            stats.update({
+                'bytes':       self.size,
+                'max_bytes':   self.max_bytes,
+                'ttl':         self.ttl,
+                'expirations': self.expirations,
+                })
+        return stats
+
+    def _evict(self):
+        while self.entries and (
+                len(self.entries) > max(0, self.capacity) or
+                self.size > self.max_bytes):
+            key, (value, expires, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
@@ -0,0 +1,155 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import math
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ExpiringSet(object):
+    """An exact set of message ids which forgets each id ttl seconds after it
+    was added, and forgets the oldest ids when it holds more than max_size.
+    """
+
+    def __init__(self, ttl=86400, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = time.time
+        self.lock = threading.Lock()
+        # Maps each id to the time it was added, oldest first
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        with self.lock:
+            self._expire()
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            self._expire()
+            return key in self.entries
+
+    def add(self, key):
+        """Add key, returning False if it was already present."""
+        with self.lock:
+            self._expire()
+            if key in self.entries:
+                return False
+            self.entries[key] = self.clock()
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        """Remove key if it is present."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _expire(self):
+        limit = self.clock() - self.ttl
+        while self.entries and self.entries[next(iter(self.entries))] <= limit:
+            self.entries.popitem(last=False)
+
+
+class RotatingBloomFilter(object):
+    """A fixed size set of message ids built from a pair of Bloom filters.
+
+    Ids are added to the current filter and looked up in both. The current
+    filter becomes the previous one (and the previous one is discarded) every
+    ttl seconds, or sooner if capacity ids have been added to it, so ids are
+    remembered for at least ttl seconds unless more than capacity arrive in
+    that time. The filters are sized so that no more than error_rate of the
+    lookups of unseen ids wrongly find them.
+    """
+
+    def __init__(self, ttl=86400, capacity=100000, error_rate=0.001):
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+        self.ttl = ttl
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Each filter holds up to capacity ids but lookups test both, hence
+        # the halved error rate
+        self.bits = int(math.ceil(
+            -capacity * math.log(error_rate / 2) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.clock = time.time
+        self.lock = threading.Lock()
+        self.current = bytearray((self.bits + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+        self.rotated = None
+
+    def __len__(self):
+        # An estimate; the previous filter's count isn't kept
+        with self.lock:
+            self._expire()
+            return self.count
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        with self.lock:
+            self._expire()
+            return (
+                self._test(self.current, positions) or
+                self._test(self.previous, positions))
+
+    def add(self, key):
+        """Add key, returning False if it was (probably) already present."""
+        positions = self._positions(key)
+        with self.lock:
+            self._expire()
+            if self._test(self.current, positions):
+                return False
+            found = self._test(self.previous, positions)
+            for p in positions:
+                self.current[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+            return not found
+
+    def discard(self, key):
+        """Does nothing: a Bloom filter can't forget a single key, which is
+        remembered until it's rotated out."""
+        pass
+
+    def _positions(self, key):
+        # Double hashing: derive all the bit positions from two 64-bit hashes
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack_from(b'<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _test(self, bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def _expire(self):
+        now = self.clock()
+        if self.rotated is None:
+            self.rotated = now
+        if now - self.rotated >= 2 * self.ttl:
+            self.previous = bytearray(len(self.current))
+            self.current = bytearray(len(self.current))
+        elif now - self.rotated >= self.ttl or self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(len(self.current))
+        else:
+            return
+        self.count = 0
+        self.rotated = now
+
+
+def dedup_store(ttl=86400, max_size=100000, error_rate=0):
+    """Return an ExpiringSet, or a RotatingBloomFilter if a non-zero
+    error_rate is given."""
+    if error_rate:
+        return RotatingBloomFilter(ttl, max_size, error_rate)
+    return ExpiringSet(ttl, max_size)
@@ -0,0 +1,145 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import threading
+import importlib
+from types import ModuleType
+
+from ..rules import WordIndex, PhonemeMatcher, StructureMatcher
+
+
+class Dialect(object):
+    """A dialect compiled from the rules of a dialect module.
+
+    A dialect module defines ignores, word_rules, phoneme_rules and
+    structure_rules and optionally the name of its part-of-speech tagger
+    backend as tagger. A Dialect validates those rules and compiles them once
+    into a WordIndex, PhonemeMatcher and StructureMatcher. Dialects are
+    immutable so may be shared between threads, and pickle by name so that
+    each worker process compiles a dialect only once.
+
+    Use get() or compiled() rather than constructing Dialects directly.
+    """
+
+    __slots__ = (
+        'name',
+        'tagger',
+        'ignores',
+        'word_rules',
+        'phoneme_rules',
+        'structure_rules',
+        'word_index',
+        'phoneme_matcher',
+        'structure_matcher',
+        )
+
+    def __init__(self, module):
+        init = super(Dialect, self).__setattr__
+        init('name', module.__name__)
+        init('tagger', getattr(module, 'tagger', None))
+        ignores = module.ignores
+        if hasattr(ignores, '__iter__'):
+            ignores = frozenset(ignores)
+        init('ignores', ignores)
+        init('word_rules', tuple(
+            (patterns, tuple(replacements))
+            for patterns, replacements in module.word_rules))
+        init('phoneme_rules', tuple(
+            (tuple(tuple(pattern) for pattern in patterns), tuple(replacement))
+            for patterns, replacement in module.phoneme_rules))
+        init('structure_rules', tuple(
+            (tuple(tuple(pattern) for pattern in patterns),
+                tuple(tuple(replacement) for replacement in replacements),
+                chance)
+            for patterns, replacements, chance in module.structure_rules))
+        self.validate()
+        init('word_index', WordIndex(self.word_rules))
+        init('phoneme_matcher', PhonemeMatcher(self.phoneme_rules))
+        init('structure_matcher', StructureMatcher(self.structure_rules))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Dialect objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Dialect objects are immutable')
+
+    def __reduce__(self):
+        return (get, (self.name,))
+
+    def __repr__(self):
+        return '<Dialect %s>' % self.name
+
+    def validate(self):
+        """Raise ValueError if any of the dialect's rules are malformed."""
+        for patterns, replacements in self.word_rules:
+            if not replacements:
+                raise ValueError(
+                    '%s: word rule has no replacements' % self.name)
+        for patterns, replacement in self.phoneme_rules:
+            for pattern in patterns:
+                self._validate_pattern(pattern, replacement)
+        for patterns, replacements, chance in self.structure_rules:
+            if not replacements:
+                raise ValueError(
+                    '%s: structure rule has no replacements' % self.name)
+            if not 0 <= chance <= 1:
+                raise ValueError(
+                    '%s: structure rule chance %r is not between 0 and 1' % (
+                        self.name, chance))
+            for pattern in patterns:
+                for replacement in replacements:
+                    self._validate_pattern(pattern, replacement)
+
+    def _validate_pattern(self, pattern, replacement):
+        if not pattern:
+            raise ValueError('%s: empty pattern' % self.name)
+        for element in pattern:
+            if not isinstance(element, (str, bytes)) or not element:
+                raise ValueError(
+                    '%s: invalid pattern element %r' % (self.name, element))
+        for element in replacement:
+            if type(element) == int:
+                if not 0 <= element < len(pattern):
+                    raise ValueError(
+                        '%s: replacement %r refers outside pattern %r' % (
+                            self.name, replacement, pattern))
+            elif not isinstance(element, (str, bytes)):
+                raise ValueError(
+                    '%s: invalid replacement element %r' % (self.name, element))
+
+
+_dialects = {}
+_dialects_lock = threading.Lock()
+
+
+def get(name):
+    """Return the Dialect compiled from the module called name.
+
+    name may be a bundled dialect's short name (e.g. "manc") or the full
+    name of a dialect module. Each dialect is compiled once per process.
+    """
+    if '.' not in name:
+        name = '%s.%s' % (__name__, name)
+    try:
+        return _dialects[name]
+    except KeyError:
+        pass
+    module = importlib.import_module(name)
+    with _dialects_lock:
+        if name not in _dialects:
+            _dialects[name] = Dialect(module)
+        return _dialects[name]
+
+
+def compiled(dialect):
+    """Return dialect, which may be a Dialect or a dialect module, as a Dialect."""
+    if isinstance(dialect, ModuleType):
+        return get(dialect.__name__)
+    return dialect
@@ -5,14 +5,39 @@ from __future__ import (
     print_function,
 )
 
+import threading
 from collections import namedtuple
 from itertools import izip_longest
 
-from nltk.corpus import cmudict
+from . import snapshot as _snapshot
 
 
-# The CMU pronunciation dictionary
-phoneme_dict = cmudict.dict()
+# A prebuilt, memory-mapped snapshot of the dictionary (see mancify.snapshot)
+# if one exists. Loaded with phoneme_dict
+snapshot = None
+
+# The CMU pronunciation dictionary, loaded on first use by load()
+phoneme_dict = None
+_load_lock = threading.Lock()
+
+
+def load():
+    """Load and return the pronunciation dictionary if it isn't already loaded.
+
+    The snapshot is used if there is one, otherwise NLTK's CMU dictionary
+    corpus is read, which takes some seconds.
+    """
+    global snapshot, phoneme_dict
+    if phoneme_dict is None:
+        with _load_lock:
+            if phoneme_dict is None:
+                snapshot = _snapshot.load()
+                if snapshot is not None:
+                    phoneme_dict = snapshot
+                else:
+                    from nltk.corpus import cmudict
+                    phoneme_dict = cmudict.dict()
+    return phoneme_dict
 
 
 # A phoneme with associated word fragment
@@ -189,7 +214,7 @@ def distribute_letters(phonemes, letters):
 
 def phonemes(word):
     """Return a list of phonemes for the given word.""" 
-    return phoneme_dict[word.lower()][0]
+    return load()[word.lower()][0]
 
 
 def pronounce(word):
@@ -207,12 +232,22 @@ def pronounce(word):
     Raises KeyError if the word is not recognised.
 
     """
+    load()
+    if snapshot is not None:
+        result = snapshot.pronounce(word)
+        if result is not None:
+            return result
+    return align(word, phonemes(word))
+
+
+def align(word, pronunciation):
+    """Align the given list of phonemes with the letters of word as described
+    in pronounce()."""
     remainder = word.lower()
     vowel_phonemes = []
     result = []
 
     # Get phonemes for the given word zipped with same phonemes looking forward one index
-    pronunciation = phonemes(word)
     pronunciation2 = iter(pronunciation)
     next(pronunciation2)
     for phoneme, next_phoneme in izip_longest(pronunciation, pronunciation2):
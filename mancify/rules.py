@@ -0,0 +1,266 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import re
+import random
+import threading
+
+from .pronunciation import grapheme, Phoneme
+
+
+# Regex match a digit
+match_digits = re.compile(r'\d')
+
+
+# Kinds of element in a compiled phoneme pattern
+VOWEL, CONS, EXACT, BASE = range(4)
+
+
+class WordIndex(object):
+    """A dialect's word rules indexed by word.
+
+    Where a word appears in more than one rule the first rule wins, as it
+    would when scanning the rules in order. A rule whose patterns cannot be
+    enumerated (such as a set that contains everything) becomes the default
+    for all words not indexed before it, and any rules following it are
+    unreachable.
+
+    """
+
+    def __init__(self, rules):
+        self.index = {}
+        self.default = None
+        for patterns, replacements in rules:
+            if not hasattr(patterns, '__iter__'):
+                self.default = replacements
+                break
+            for word in patterns:
+                self.index.setdefault(word, replacements)
+
+    def get(self, word):
+        """Return the replacements for word or None if it has none."""
+        return self.index.get(word, self.default)
+
+
+class PhonemeTable(object):
+    """Intern phoneme strings as small integer IDs.
+
+    Alongside each ID the table records everything the phoneme rules need to
+    know about a phoneme so that none of it has to be re-derived from the
+    string while matching: whether it is a vowel, the ID of its stress-stripped
+    form (e.g. 'AE' for 'AE1') and its most intuitive grapheme. ID 0 is always
+    the empty phoneme given to unpronounced letters, which never matches.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ids = {}
+        self.names = []
+        self.vowels = []
+        self.bases = []
+        self.graphemes = []
+        self.intern('')
+
+    def intern(self, phoneme):
+        """Return the ID of the given phoneme, allocating one if necessary."""
+        try:
+            return self.ids[phoneme]
+        except KeyError:
+            pass
+        base = match_digits.sub('', phoneme)
+        base_id = self.intern(base) if base != phoneme else None
+        with self.lock:
+            if phoneme not in self.ids:
+                phoneme_id = len(self.names)
+                self.names.append(phoneme)
+                self.vowels.append(bool(phoneme) and phoneme[0] in 'AEIOU')
+                self.bases.append(phoneme_id if base_id is None else base_id)
+                self.graphemes.append(grapheme(phoneme))
+                # Publish the ID last so lock-free readers never see a
+                # partially recorded phoneme
+                self.ids[phoneme] = phoneme_id
+            return self.ids[phoneme]
+
+
+# The table shared by all compiled dialects
+phoneme_table = PhonemeTable()
+
+
+class PhonemeMatcher(object):
+    """A dialect's phoneme rules compiled against a PhonemeTable.
+
+    Each pattern is compiled to a tuple of (kind, phoneme ID) elements and each
+    replacement to a tuple of (offset, phoneme ID, grapheme) elements where
+    offset is None for a literal phoneme. Rules are applied in order, each one
+    seeing the output of the last, exactly as the dialect defines them.
+
+    """
+
+    def __init__(self, rules, table=phoneme_table):
+        self.table = table
+        self.start = table.intern('START')
+        self.end = table.intern('END')
+        self.rules = [
+            (self.compile_pattern(pattern), self.compile_replacement(replacement))
+            for patterns, replacement in rules
+            for pattern in patterns
+            ]
+
+    def compile_pattern(self, pattern):
+        result = []
+        for pfon in pattern:
+            if pfon == 'VOWEL':
+                result.append((VOWEL, None))
+            elif pfon == 'CONS':
+                result.append((CONS, None))
+            elif pfon[-1].isdigit():
+                # Match vowel stress digit if it exists in the pattern
+                result.append((EXACT, self.table.intern(pfon)))
+            else:
+                # ...otherwise ignore it
+                result.append((BASE, self.table.intern(pfon)))
+        return tuple(result)
+
+    def compile_replacement(self, replacement):
+        result = []
+        for rfon in replacement:
+            if type(rfon) == int:
+                result.append((rfon, None, None))
+            else:
+                phoneme_id = self.table.intern(rfon)
+                result.append((None, phoneme_id, self.table.graphemes[phoneme_id]))
+        return tuple(result)
+
+    def match(self, ids, i, pattern):
+        """Match the compiled pattern from position i in a list of phoneme IDs."""
+        if i + len(pattern) > len(ids):
+            return False
+        vowels = self.table.vowels
+        bases = self.table.bases
+        for kind, value in pattern:
+            phoneme_id = ids[i]
+            i += 1
+            if not phoneme_id:
+                return False
+            elif kind == VOWEL:
+                if not vowels[phoneme_id]:
+                    return False
+            elif kind == CONS:
+                if vowels[phoneme_id]:
+                    return False
+            elif kind == EXACT:
+                if phoneme_id != value:
+                    return False
+            elif bases[phoneme_id] != value:
+                return False
+        return True
+
+    def apply(self, phons, stats=None):
+        """Apply the rules to a list of Phoneme tuples returning a new list.
+
+        Rule matches are counted in stats, if given.
+        """
+        intern = self.table.intern
+        ids = [self.start] + [intern(p.phoneme) for p in phons] + [self.end]
+        graphemes = [''] + [p.grapheme for p in phons] + ['']
+        for pattern, replacement in self.rules:
+            size = len(pattern)
+            for i in range(len(ids)):
+                if self.match(ids, i, pattern):
+                    if stats is not None:
+                        stats.count('phoneme_matches')
+                    ids[i:i + size], graphemes[i:i + size] = (
+                        [ids[i + offset] if offset is not None else phoneme_id
+                            for offset, phoneme_id, _ in replacement],
+                        [graphemes[i + offset] if offset is not None else letters
+                            for offset, _, letters in replacement],
+                        )
+        names = self.table.names
+        return [
+            Phoneme(phoneme=names[phoneme_id], grapheme=letters)
+            for phoneme_id, letters in zip(ids[1:-1], graphemes[1:-1])
+            ]
+
+
+class TagPattern(object):
+    """A single part-of-speech pattern element such as 'NN' or 'JJ*'.
+
+    Elements are regular expressions in which '*' stands for '.*' and which
+    must match a tag in its entirety. As a tagset is small, the result for each
+    tag is remembered so each distinct tag is only ever tested once.
+
+    """
+
+    def __init__(self, ptag):
+        self.ptag = ptag
+        self.regex = re.compile('^' + ptag.replace('*', '.*') + '$')
+        self.results = {}
+
+    def __call__(self, tag):
+        try:
+            return self.results[tag]
+        except KeyError:
+            return self.results.setdefault(tag, bool(self.regex.match(tag)))
+
+
+_tag_patterns = {}
+
+def tag_pattern(ptag):
+    """Return the shared TagPattern for the given pattern element."""
+    try:
+        return _tag_patterns[ptag]
+    except KeyError:
+        return _tag_patterns.setdefault(ptag, TagPattern(ptag))
+
+
+class StructureMatcher(object):
+    """A dialect's structure rules compiled to sequences of TagPatterns.
+
+    Each pattern of each rule is tried in order. A pattern is scanned across
+    the tagged stream once and every match is accepted with the rule's chance;
+    the first accepted match is spliced in place with a randomly chosen
+    replacement and the scan moves on to the next pattern.
+
+    """
+
+    def __init__(self, rules):
+        self.rules = [
+            (tuple(tag_pattern(ptag) for ptag in pattern), replacements, chance)
+            for patterns, replacements, chance in rules
+            for pattern in patterns
+            ]
+
+    def apply(self, tagged, rng=random, stats=None):
+        """Apply the rules to a list of (word, tag) tuples in place, making
+        random choices with rng and counting accepted matches in stats, if
+        given."""
+        tags = [tag for word, tag in tagged]
+        for pattern, replacements, chance in self.rules:
+            size = len(pattern)
+            first = pattern[0]
+            for i in range(len(tags) - size + 1):
+                if not first(tags[i]):
+                    continue
+                if not all(element(tag) for element, tag in zip(pattern[1:], tags[i + 1:i + size])):
+                    continue
+                if rng.random() >= chance:
+                    continue
+                replacement = [
+                    tagged[i + r] if type(r) == int else (r, '?')
+                    for r in rng.choice(replacements)
+                    ]
+                tagged[i:i + size] = replacement
+                tags[i:i + size] = [tag for word, tag in replacement]
+                if stats is not None:
+                    stats.count('structure_matches')
+                break
+        return tagged
+
@@ -9,63 +9,389 @@ from __future__ import (
 str = type('')
 
 import re
+import time
 import logging
+import threading
+from collections import OrderedDict, deque
 
 from clockwork import clockwork
 
+from mancify.workers import QueueFull
+
 
 # Maximum length of an SMS message (with triple concatenation, the maximum
 # permitted under GSM)
 SMS_MAX_LENGTH = 459
 
+# The maximum number of segments concatenated into one message
+SMS_MAX_PARTS = 3
+
+# The default limit on the length of each reply: ten triple concatenated
+# messages
+SMS_LIMIT = 10 * SMS_MAX_LENGTH
+
+# The capacity of a single SMS and of each segment of a concatenated SMS, in
+# septets for the GSM 7-bit alphabet and in UTF-16 code units for UCS-2
+GSM_SINGLE = 160
+GSM_MULTI = 153
+UCS2_SINGLE = 70
+UCS2_MULTI = 67
+
+# The GSM 7-bit default alphabet, and its extension table whose characters
+# take two septets (an escape and the character)
+GSM_BASIC = frozenset(
+    '@\u00a3$\u00a5\u00e8\u00e9\u00f9\u00ec\u00f2\u00c7\n\u00d8\u00f8\r'
+    '\u00c5\u00e5\u0394_\u03a6\u0393\u039b\u03a9\u03a0\u03a8\u03a3\u0398'
+    '\u039e\u00c6\u00e6\u00df\u00c9 !"#\u00a4%&\'()*+,-./0123456789:;<=>?'
+    '\u00a1ABCDEFGHIJKLMNOPQRSTUVWXYZ\u00c4\u00d6\u00d1\u00dc\u00a7\u00bf'
+    'abcdefghijklmnopqrstuvwxyz\u00e4\u00f6\u00f1\u00fc\u00e0')
+GSM_EXTENDED = frozenset('\f^{}\\[~]|\u20ac')
+
+# A page is broken at a space or line break if there's one within this many
+# characters of the end
+BREAK_DISTANCE = 10
+
+# Runs of spaces, and of line breaks
+whitespace_re = re.compile(r' {2,}|(?:\r?\n)+')
+
+# Any character outside the GSM 7-bit default alphabet
+non_gsm_re = re.compile(
+    '[^%s]' % ''.join(re.escape(c) for c in sorted(GSM_BASIC)))
+
+
+def normalize(content):
+    """Strip content and replace runs of spaces and line breaks with single
+    ones (no sense wasting credits on them)."""
+    return whitespace_re.sub(
+        lambda m: ' ' if m.group().startswith(' ') else '\n', content.strip())
+
+
+class Segments(object):
+    """Counts the segments needed to send a message as characters are added.
+
+    Characters can't be split across the segments of a concatenated message
+    so a character which doesn't fit in the remainder of one starts the next.
+    """
+
+    def __init__(self, single, multi):
+        self.single = single
+        self.multi = multi
+        self.size = 0
+        self.segments = 1
+        self.used = 0
+
+    def add(self, width):
+        self.size += width
+        if self.used + width > self.multi:
+            self.segments += 1
+            self.used = width
+        else:
+            self.used += width
+
+    @property
+    def count(self):
+        return 1 if self.size <= self.single else self.segments
+
+
+def count_segments(text):
+    """Return the number of SMS segments needed to send text as a single
+    message, and whether it can be encoded with the GSM 7-bit alphabet."""
+    gsm = Segments(GSM_SINGLE, GSM_MULTI)
+    ucs2 = Segments(UCS2_SINGLE, UCS2_MULTI)
+    is_gsm = True
+    for c in text:
+        if is_gsm:
+            if c in GSM_BASIC:
+                gsm.add(1)
+            elif c in GSM_EXTENDED:
+                gsm.add(2)
+            else:
+                is_gsm = False
+        ucs2.add(2 if ord(c) > 0xFFFF else 1)
+    return (gsm.count, True) if is_gsm else (ucs2.count, False)
+
+
+def chunk_end(text, start, stop, prefix='', parts=SMS_MAX_PARTS):
+    """Return the index up to which text[start:stop], after prefix, fits in
+    a message of parts segments. The message is encoded with the GSM
+    alphabet, ending before the first character outside it unless switching
+    to UCS-2 (with its smaller capacity) makes for a longer message.
+
+    The prefix must be in the GSM alphabet."""
+    # The common case of a chunk of characters from the GSM alphabet (which
+    # each take one septet) can be found without examining each of them
+    capacity = (GSM_SINGLE if parts == 1 else GSM_MULTI * parts) - len(prefix)
+    end = min(stop, start + capacity)
+    if not non_gsm_re.search(text, start, end):
+        return end
+    gsm = Segments(GSM_SINGLE, GSM_MULTI)
+    ucs2 = Segments(UCS2_SINGLE, UCS2_MULTI)
+    for c in prefix:
+        gsm.add(1)
+        ucs2.add(1)
+    is_gsm = True
+    ucs2_full = False
+    i = start
+    while i < stop:
+        c = text[i]
+        if is_gsm:
+            if c in GSM_BASIC:
+                width = 1
+            elif c in GSM_EXTENDED:
+                width = 2
+            else:
+                is_gsm = False
+        if not ucs2_full:
+            ucs2.add(2 if ord(c) > 0xFFFF else 1)
+            ucs2_full = ucs2.count > parts
+        if is_gsm:
+            gsm.add(width)
+            if gsm.count > parts:
+                return i
+        elif ucs2_full:
+            # Don't split a surrogate pair (on narrow builds)
+            if i > start and '\ud800' <= text[i - 1] <= '\udbff':
+                i -= 1
+            return i
+        i += 1
+    return stop
+
+
+def segment(text, parts=SMS_MAX_PARTS, output_limit=None):
+    """Split text into messages of no more than parts segments each, in a
+    single pass over it. If more than one message is needed each is prefixed
+    with a page number, and pages are broken at a space or line break near
+    their end where possible. No more than output_limit characters of text
+    are sent; if text is longer the last message ends with "...".
+    """
+    stop = len(text)
+    if output_limit is not None:
+        stop = min(stop, output_limit)
+    if chunk_end(text, 0, stop, '', parts) == stop:
+        if stop < len(text):
+            yield text[:max(0, stop - 3)] + '...'
+        elif text:
+            yield text
+        return
+    start = 0
+    page = 1
+    while start < stop:
+        prefix = 'p%d:\n' % page
+        end = chunk_end(text, start, stop, prefix, parts)
+        if end == stop:
+            if stop < len(text):
+                yield prefix + text[start:max(start, end - 3)] + '...'
+            else:
+                yield prefix + text[start:end]
+            return
+        # Try and split on a line break or a space if one is near the end of
+        # the current chunk
+        split = max(
+            text.rfind(' ', end - BREAK_DISTANCE, end),
+            text.rfind('\n', end - BREAK_DISTANCE, end))
+        if split > start:
+            yield prefix + text[start:split]
+            start = split + 1
+        else:
+            yield prefix + text[start:end]
+            start = end
+        while start < stop and text[start] in ' \n':
+            start += 1
+        page += 1
+
 
 class MancifySMSService(object):
-    def __init__(self, api_key):
+    def __init__(self, api_key, output_limit=None):
         self.api = clockwork.API(api_key)
+        self.output_limit = output_limit
 
     def send(self, sender, recipient, content):
         logging.debug('Sending message to %s', recipient)
         for chunk in self.format(content):
-            # Send up to 459 characters at a time (the maximum length of a
+            # Send up to 3 segments at a time (the maximum length of a
             # triple concatenated SMS message)
-            msg = clockwork.SMS(to=recipient, from_name=sender, message=chunk)
-            response = self.api.send(msg)
+            response = self.api.send(self.message(sender, recipient, chunk))
             if not response.success:
                 logging.error('%s %s', response.error_code, response.error_description)
 
+    def message(self, sender, recipient, chunk):
+        return clockwork.SMS(to=recipient, from_name=sender, message=chunk)
+
     def format(self, content):
-        # Replace multiple consecutive spaces and line breaks with individual
-        # spaces and line breaks (no sense wasting credits on them)
-        content = content.strip()
-        content = re.sub(' +', ' ', content)
-        content = re.sub('\r\n', '\n', content)
-        content = re.sub('\n+', '\n', content)
-        # If necessary, chunk content into SMS_MAX_LENGTH chunks, prefixing
-        # each with a page number
-        if len(content) < SMS_MAX_LENGTH:
-            yield content
-        else:
-            sent = 0
-            page = 1
-            while content and sent < self.output_limit:
-                content = 'p%d:\n%s' % (page, content.strip())
-                if (sent + SMS_MAX_LENGTH) > self.output_limit:
-                    chunk = content[:SMS_MAX_LENGTH - 3] + '...'
-                    content = ''
-                elif len(content) < SMS_MAX_LENGTH:
-                    chunk = content
-                    content = ''
-                else:
-                    # Try and split on a line break or a space if one is near
-                    # the end of the current chunk
-                    match = re.match('(.*)[ \n](.*)', content[:SMS_MAX_LENGTH], re.DOTALL)
-                    if match and len(match.group(2)) < 10:
-                        chunk = match.group(1)
-                        content = match.group(2) + content[SMS_MAX_LENGTH:]
+        return segment(
+            normalize(content), SMS_MAX_PARTS, self.output_limit)
+
+
+class SMSDispatcher(object):
+    """Sends messages through a MancifySMSService on a pool of background
+    threads, in place of its blocking send method.
+
+    Each recipient's chunks are sent in order, one at a time, while the first
+    chunks waiting for up to batch_size different recipients are sent together
+    in a single API call. A chunk which fails is retried up to retries times,
+    backing off exponentially from backoff seconds; the recipient's later
+    chunks wait behind it. No more than max_queue chunks may be waiting;
+    beyond that send raises QueueFull.
+
+    Delivery is at-least-once. The chunks the API reports as failed are
+    retried, but if the call itself raises (a connection reset or a timeout
+    reading the response, say) there's no telling which chunks the gateway
+    accepted before the error, so the whole batch is retried and some
+    recipients may receive a chunk twice. With retries=0 delivery is
+    at-most-once instead.
+    """
+
+    def __init__(
+            self, service, workers=2, max_queue=1000, batch_size=50,
+            retries=3, backoff=1.0):
+        self.service = service
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.cond = threading.Condition()
+        # Maps each recipient to a deque of [message, queued time, attempts]
+        # in the order recipients were last served
+        self.pending = OrderedDict()
+        self.busy = set()
+        self.retry_at = {}
+        self.depth = 0
+        self.closing = False
+        self.batches = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.threads = [
+            threading.Thread(target=self._run, name='sms-%d' % i)
+            for i in range(workers)
+            ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def send(self, sender, recipient, content):
+        chunks = list(self.service.format(content))
+        now = time.time()
+        with self.cond:
+            if self.closing:
+                raise QueueFull('SMS dispatcher is closed')
+            if self.depth + len(chunks) > self.max_queue:
+                raise QueueFull('SMS queue is full')
+            logging.debug('Queueing message to %s', recipient)
+            queue = self.pending.setdefault(recipient, deque())
+            for chunk in chunks:
+                queue.append(
+                    [self.service.message(sender, recipient, chunk), now, 0])
+            self.depth += len(chunks)
+            self.cond.notify_all()
+
+    def close(self, timeout=5):
+        """Stop the workers once the queue is empty, waiting up to timeout
+        seconds for each of them."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """Return a dict of the queue depth, counters and the latency between
+        queueing and sending chunks."""
+        with self.cond:
+            return {
+                'workers':     len(self.threads),
+                'depth':       self.depth,
+                'capacity':    self.max_queue,
+                'recipients':  len(self.pending),
+                'batches':     self.batches,
+                'sent':        self.sent,
+                'failed':      self.failed,
+                'retried':     self.retried,
+                'latency_avg': self.latency_total / self.sent if self.sent else None,
+                'latency_max': self.latency_max,
+                }
+
+    def _next_batch(self):
+        # Return the first waiting chunk of each idle recipient, up to
+        # batch_size of them, and how long to wait for a retry if there are
+        # none
+        now = time.time()
+        batch = []
+        wait = None
+        for recipient, queue in self.pending.items():
+            if recipient in self.busy:
+                continue
+            retry_at = self.retry_at.get(recipient, 0)
+            if retry_at > now:
+                wait = retry_at - now if wait is None else min(wait, retry_at - now)
+                continue
+            batch.append((recipient, queue[0]))
+            if len(batch) == self.batch_size:
+                break
+        return batch, wait
+
+    def _send_batch(self, messages):
+        # Return a response for each message, or None for those which may not
+        # have been accepted by the gateway and should be retried
+        try:
+            responses = self.service.api.send(messages)
+        except Exception:
+            # The gateway may have accepted some or all of the batch before
+            # the error, but retrying it is preferred to losing messages
+            logging.exception('Error sending %d messages', len(messages))
+            return [None] * len(messages)
+        # The API returns a single response when given a single message
+        if not isinstance(responses, list):
+            responses = [responses]
+        return responses + [None] * (len(messages) - len(responses))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    batch, wait = self._next_batch()
+                    if batch or (self.closing and not self.depth):
+                        break
+                    self.cond.wait(wait)
+                if not batch:
+                    return
+                for recipient, item in batch:
+                    # Move the recipient to the back of the line so others
+                    # get a turn in the next batch
+                    self.busy.add(recipient)
+                    self.pending[recipient] = self.pending.pop(recipient)
+                self.batches += 1
+            responses = self._send_batch([item[0] for recipient, item in batch])
+            with self.cond:
+                now = time.time()
+                for (recipient, item), response in zip(batch, responses):
+                    self.busy.discard(recipient)
+                    if response is not None and response.success:
+                        self.sent += 1
+                        self.latency_total += now - item[1]
+                        self.latency_max = max(self.latency_max, now - item[1])
+                        self._done(recipient)
+                        continue
+                    if response is not None:
+                        logging.error(
+                            '%s %s', response.error_code,
+                            response.error_description)
+                    item[2] += 1
+                    if item[2] > self.retries:
+                        self.failed += 1
+                        self._done(recipient)
                     else:
-                        chunk = content[:SMS_MAX_LENGTH]
-                        content = content[SMS_MAX_LENGTH:]
-                yield chunk
-                sent += len(chunk)
-                page += 1
+                        self.retried += 1
+                        self.retry_at[recipient] = (
+                            now + self.backoff * 2 ** (item[2] - 1))
+                self.cond.notify_all()
 
+    def _done(self, recipient):
+        queue = self.pending[recipient]
+        queue.popleft()
+        self.depth -= 1
+        self.retry_at.pop(recipient, None)
+        if not queue:
+            del self.pending[recipient]
@@ -0,0 +1,244 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import os
+import io
+import mmap
+import struct
+import logging
+
+
+# Determine the location of the current module on the filesystem
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+# The default location of the snapshot, overridden by MANCIFY_SNAPSHOT
+DEFAULT_PATH = os.path.join(HERE, 'pronunciation.dat')
+
+# Snapshot layout, all integers little-endian:
+#
+#   header:   magic, word count, offset of phoneme table, offset of index
+#   phonemes: count (B) then for each phoneme its length (B) and ASCII bytes
+#   index:    word count offsets (I) to records sorted by UTF-8 encoded word
+#   records:  word length (B), word, phoneme count (B), phoneme IDs (B each),
+#             pair count (B, NOT_ALIGNED if pronounce() failed) then for
+#             each pair a phoneme ID (B), grapheme length (B) and grapheme
+MAGIC = b'MNCPRON1'
+HEADER = struct.Struct(b'<8sIII')
+BYTE = struct.Struct(b'<B')
+OFFSET = struct.Struct(b'<I')
+NOT_ALIGNED = 0xFF
+
+
+def snapshot_path():
+    """Return the path of the pronunciation snapshot."""
+    return os.environ.get('MANCIFY_SNAPSHOT', DEFAULT_PATH)
+
+
+class Snapshot(object):
+    """A read-only, memory-mapped view of a pronunciation snapshot.
+
+    The snapshot behaves like the CMU dictionary mapping lowercase words to a
+    list of pronunciations except that only the first pronunciation of each
+    word is stored. As the file is mapped rather than read, opening it is
+    near-instant and its pages are shared by every process using it.
+
+    """
+
+    def __init__(self, path):
+        with io.open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, phonemes_offset, self.index_offset = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a pronunciation snapshot' % path)
+        self.phonemes = []
+        (count,) = BYTE.unpack_from(self.map, phonemes_offset)
+        offset = phonemes_offset + 1
+        for i in range(count):
+            (size,) = BYTE.unpack_from(self.map, offset)
+            self.phonemes.append(self.map[offset + 1:offset + 1 + size].decode('ascii'))
+            offset += 1 + size
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Words are yielded in the order of their UTF-8 encodings
+        for i in range(self.count):
+            (offset,) = OFFSET.unpack_from(self.map, self.index_offset + i * OFFSET.size)
+            yield self._word_at(offset).decode('utf-8')
+
+    def keys(self):
+        return list(self)
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+    def __contains__(self, word):
+        return self._find(word) is not None
+
+    def __getitem__(self, word):
+        offset = self._find(word)
+        if offset is None:
+            raise KeyError(word)
+        phonemes, offset = self._read_phonemes(offset)
+        return [phonemes]
+
+    def pronounce(self, word):
+        """Return the stored result of pronounce() for word, None if it was
+        not stored, or raise KeyError if the word is not recognised."""
+        from .pronunciation import Phoneme
+
+        offset = self._find(word.lower())
+        if offset is None:
+            raise KeyError(word)
+        phonemes, offset = self._read_phonemes(offset)
+        (count,) = BYTE.unpack_from(self.map, offset)
+        if count == NOT_ALIGNED:
+            return None
+        offset += 1
+        result = []
+        for i in range(count):
+            phoneme_id, size = struct.unpack_from(b'<BB', self.map, offset)
+            offset += 2
+            result.append(Phoneme(
+                phoneme=self.phonemes[phoneme_id],
+                grapheme=self.map[offset:offset + size].decode('utf-8')))
+            offset += size
+        return result
+
+    def _word_at(self, offset):
+        (size,) = BYTE.unpack_from(self.map, offset)
+        return self.map[offset + 1:offset + 1 + size]
+
+    def _read_phonemes(self, offset):
+        (size,) = BYTE.unpack_from(self.map, offset)
+        offset += 1 + size
+        (count,) = BYTE.unpack_from(self.map, offset)
+        offset += 1
+        phonemes = [
+            self.phonemes[phoneme_id]
+            for phoneme_id in struct.unpack_from(b'<%dB' % count, self.map, offset)
+            ]
+        return phonemes, offset + count
+
+    def _find(self, word):
+        # Binary search the sorted index for the record of word
+        key = word.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (offset,) = OFFSET.unpack_from(self.map, self.index_offset + mid * OFFSET.size)
+            found = self._word_at(offset)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return offset
+        return None
+
+
+def load(path=None):
+    """Return the Snapshot at path (or snapshot_path()), or None if there is
+    no snapshot there or it can't be read."""
+    if path is None:
+        path = snapshot_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        return Snapshot(path)
+    except (ValueError, IOError, OSError, struct.error) as e:
+        logging.warning('Ignoring pronunciation snapshot %s: %s', path, e)
+        return None
+
+
+def build(path=None, entries=None):
+    """Write a snapshot of the CMU dictionary and the pronounce() alignment of
+    each of its words to path (or snapshot_path()).
+
+    entries is an iterable of (word, pronunciations) tuples and defaults to the
+    entries of the CMU dictionary.
+    """
+    from .pronunciation import align
+
+    if path is None:
+        path = snapshot_path()
+    if entries is None:
+        from nltk.corpus import cmudict
+        entries = cmudict.dict().items()
+
+    phoneme_ids = {'': 0}
+    def phoneme_id(phoneme):
+        return phoneme_ids.setdefault(phoneme, len(phoneme_ids))
+
+    records = []
+    for word, pronunciations in entries:
+        key = word.encode('utf-8')
+        phonemes = pronunciations[0]
+        record = [BYTE.pack(len(key)), key, BYTE.pack(len(phonemes))]
+        record.extend(BYTE.pack(phoneme_id(p)) for p in phonemes)
+        try:
+            aligned = align(word, phonemes)
+        except Exception:
+            aligned = None
+        if aligned is None or len(aligned) >= NOT_ALIGNED:
+            record.append(BYTE.pack(NOT_ALIGNED))
+        else:
+            record.append(BYTE.pack(len(aligned)))
+            for phoneme, letters in aligned:
+                letters = letters.encode('utf-8')
+                record.extend((BYTE.pack(phoneme_id(phoneme)), BYTE.pack(len(letters)), letters))
+        records.append((key, b''.join(record)))
+    records.sort()
+    if len(phoneme_ids) > NOT_ALIGNED:
+        raise ValueError('Too many distinct phonemes for a snapshot')
+
+    phonemes = sorted(phoneme_ids, key=phoneme_ids.get)
+    table = [BYTE.pack(len(phonemes))]
+    for phoneme in phonemes:
+        table.extend((BYTE.pack(len(phoneme)), phoneme.encode('ascii')))
+    table = b''.join(table)
+    phonemes_offset = HEADER.size
+    index_offset = phonemes_offset + len(table)
+    offset = index_offset + OFFSET.size * len(records)
+    index = []
+    for key, record in records:
+        index.append(OFFSET.pack(offset))
+        offset += len(record)
+
+    # Write to a temporary file and rename it into place so that processes
+    # mapping an existing snapshot never see a partially written one
+    temp_path = path + '.tmp'
+    with io.open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records), phonemes_offset, index_offset))
+        f.write(table)
+        f.write(b''.join(index))
+        for key, record in records:
+            f.write(record)
+    os.rename(temp_path, path)
+    return len(records)
+
+
+def main():
+    """Entry point to build the pronunciation snapshot."""
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    count = build(path)
+    print('Wrote %d words to %s' % (count, path or snapshot_path()))
+
+
+if __name__ == '__main__':
+    main()
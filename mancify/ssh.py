@@ -11,6 +11,7 @@ str = type('')
 import re
 import logging
 import socket
+import select
 from datetime import datetime
 
 from paramiko import SSHClient, SSHException, AutoAddPolicy
@@ -28,12 +29,15 @@ class MancifySSHSession(object):
     }
 
     def __init__(
-            self, sms, sender, recipient, connect_timeout=30, exec_timeout=10):
+            self, sms, sender, recipient, connect_timeout=30, exec_timeout=10,
+            translate=translator.translate, output_limit=1024):
         self.sms = sms
+        self.translate = translate
         self.sender = sender
         self.recipient = recipient
         self.connect_timeout = connect_timeout
         self.exec_timeout = exec_timeout
+        self.output_limit = output_limit
         self.timestamp = None
         self.hostname = None
         self.client = None
@@ -77,8 +81,7 @@ class MancifySSHSession(object):
             logging.debug('Executing %s for %s', content, self.recipient)
             stdin, stdout, stderr = self.client.exec_command(
                     content, timeout=self.exec_timeout)
-            out = stdout.read()
-            err = stderr.read()
+            out, err, truncated = self.read_output(stdout.channel)
             if out and err:
                 msg = 'out:%s\nerr:%s' % (out, err)
             elif out:
@@ -87,10 +90,49 @@ class MancifySSHSession(object):
                 msg = err
             else:
                 msg = "There's nothing to output!"
-            self.send(msg)
+            # The note is added after translation so it reads as intended
+            note = ''
+            if truncated:
+                note = '\n[output truncated at %d bytes]' % self.output_limit
+            self.send(msg, note)
 
-    def send(self, content):
+    def read_output(self, channel):
+        # Read no more than output_limit bytes of stdout and stderr as they
+        # arrive, closing the channel once the limit is reached rather than
+        # buffering the whole output. Returns the decoded stdout and stderr
+        # and whether the output was truncated
+        out = []
+        err = []
+        remaining = self.output_limit
+        try:
+            while remaining > 0:
+                if channel.recv_ready():
+                    data = channel.recv(remaining)
+                    out.append(data)
+                elif channel.recv_stderr_ready():
+                    data = channel.recv_stderr(remaining)
+                    err.append(data)
+                elif channel.eof_received or channel.closed:
+                    break
+                elif not select.select([channel], [], [], self.exec_timeout)[0]:
+                    raise socket.timeout('Timed out waiting for output')
+                else:
+                    continue
+                remaining -= len(data)
+            truncated = remaining <= 0 and not (
+                channel.eof_received and
+                not channel.recv_ready() and
+                not channel.recv_stderr_ready())
+        finally:
+            channel.close()
+        return (
+            b''.join(out).decode('utf-8', 'replace'),
+            b''.join(err).decode('utf-8', 'replace'),
+            truncated,
+            )
+
+    def send(self, content, note=''):
         self.sms.send(
             self.sender, self.recipient,
-            translator.translate(content, self.dialect))
+            self.translate(content, self.dialect) + note)
 
@@ -0,0 +1,299 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import io
+import os
+import time
+import errno
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from mancify.dedup import dedup_store
+from mancify.workers import QueueFull
+
+
+def process_start_time(pid):
+    """Return the start time of the process with the given pid (in clock
+    ticks since boot), or None if it can't be found, as on systems without
+    /proc."""
+    try:
+        with io.open('/proc/%d/stat' % pid, 'rb') as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # The start time is the 22nd field; the 2nd, the command name in
+    # parentheses, may itself contain spaces
+    return int(stat[stat.rindex(b')') + 2:].split()[19])
+
+
+def process_owner(pid):
+    """Return the owner name for the process with the given pid: its pid and
+    start time, so a later process reusing the pid isn't mistaken for it."""
+    start = process_start_time(pid)
+    return '%d:%d' % (pid, start) if start is not None else str(pid)
+
+
+def process_alive(owner):
+    """Return True if the process named by owner (as returned by
+    process_owner) exists."""
+    pid, _, start = owner.partition(':')
+    pid = int(pid)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    return not start or process_start_time(pid) in (None, int(start))
+
+
+class LocalState(object):
+    """The state of a single MancifyWsgiApp process: the ids of messages
+    received, and the owners of SSH sessions (always this process).
+
+    A state backend tracks which SSH sessions are owned by which process so
+    that messages for a session can be forwarded to the process holding its
+    connection.
+    """
+
+    shared = False
+
+    def __init__(self, ttl=86400, max_size=100000, error_rate=0):
+        self.messages = dedup_store(ttl, max_size, error_rate)
+
+    @property
+    def owner(self):
+        pid = os.getpid()
+        if getattr(self, '_owner_pid', None) != pid:
+            self._owner = process_owner(pid)
+            self._owner_pid = pid
+        return self._owner
+
+    def claim_message(self, msg_id):
+        """Record msg_id, returning False if it was already recorded."""
+        return self.messages.add(msg_id)
+
+    def release_message(self, msg_id):
+        """Forget msg_id, so that a message which was claimed but couldn't
+        be queued is accepted when it's retried."""
+        self.messages.discard(msg_id)
+
+    def claim_session(self, recipient, timeout):
+        """Make this process the owner of recipient's session unless another
+        live process has used it in the last timeout seconds, returning the
+        owner."""
+        return self.owner
+
+    def touch_session(self, recipient):
+        pass
+
+    def release_session(self, recipient, used=None):
+        """Give up ownership of recipient's session, unless it has been
+        claimed or used again since the time used."""
+        pass
+
+    def forward(self, owner, sender, recipient, content):
+        """Pass a message for recipient's session on to the process owner.
+        A LocalState is never asked to, as claim_session always returns this
+        process."""
+        raise AssertionError('messages are only forwarded between processes')
+
+    def take_forwarded(self, submit):
+        """Pass the messages forwarded to this process to submit(sender,
+        recipient, content), oldest first, removing each it accepts. If
+        submit raises QueueFull the message it refused, and those after it,
+        are left for the next call."""
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteState(LocalState):
+    """State shared by all the MancifyWsgiApp processes on a host through a
+    SQLite database in WAL mode.
+
+    Message ids are recorded with INSERT OR IGNORE, so only one process
+    accepts each message. Expired ids, and the oldest beyond max_size, are
+    pruned every prune_interval seconds.
+    """
+
+    shared = True
+    prune_interval = 60
+
+    def __init__(self, path, ttl=86400, max_size=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.local = threading.local()
+        # Every connection opened, by any thread, so close can close them all
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.generation = 0
+        self.pruned = 0
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'msg_id TEXT PRIMARY KEY, received REAL NOT NULL)')
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS messages_received '
+                'ON messages (received)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'recipient TEXT PRIMARY KEY, owner TEXT NOT NULL, '
+                'touched REAL NOT NULL)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS forwarded ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT NOT NULL, '
+                'sender TEXT NOT NULL, recipient TEXT NOT NULL, '
+                'content TEXT NOT NULL)')
+
+    @property
+    def db(self):
+        # One connection per thread, and per process as connections mustn't
+        # be shared across a fork. Each is only used by the thread that
+        # opened it, but may be closed by another
+        pid = os.getpid()
+        if (
+                getattr(self.local, 'pid', None) != pid or
+                self.local.generation != self.generation):
+            db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None,
+                check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with self.connections_lock:
+                self.connections.append((pid, db))
+                self.local.generation = self.generation
+            self.local.db = db
+            self.local.pid = pid
+        return self.local.db
+
+    @contextmanager
+    def _transaction(self):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+    def claim_message(self, msg_id):
+        now = time.time()
+        if now - self.pruned > self.prune_interval:
+            self.prune(now)
+        cursor = self.db.execute(
+            'INSERT OR IGNORE INTO messages (msg_id, received) VALUES (?, ?)',
+            (msg_id, now))
+        return cursor.rowcount == 1
+
+    def release_message(self, msg_id):
+        self.db.execute('DELETE FROM messages WHERE msg_id = ?', (msg_id,))
+
+    def prune(self, now=None):
+        """Forget expired message ids, and the oldest beyond max_size."""
+        if now is None:
+            now = time.time()
+        self.pruned = now
+        with self._transaction() as db:
+            db.execute(
+                'DELETE FROM messages WHERE received <= ?', (now - self.ttl,))
+            db.execute(
+                'DELETE FROM messages WHERE msg_id IN ('
+                'SELECT msg_id FROM messages ORDER BY received DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def claim_session(self, recipient, timeout):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT owner, touched FROM sessions WHERE recipient = ?',
+                (recipient,)).fetchone()
+            if row:
+                owner, touched = row
+                if (
+                        owner != self.owner and
+                        now - touched <= timeout and
+                        process_alive(owner)):
+                    return owner
+            db.execute(
+                'INSERT OR REPLACE INTO sessions (recipient, owner, touched) '
+                'VALUES (?, ?, ?)', (recipient, self.owner, now))
+            # Take over any messages forwarded to the previous owner
+            db.execute(
+                'UPDATE forwarded SET owner = ? WHERE recipient = ?',
+                (self.owner, recipient))
+        return self.owner
+
+    def touch_session(self, recipient):
+        self.db.execute(
+            'UPDATE sessions SET touched = ? WHERE recipient = ? AND owner = ?',
+            (time.time(), recipient, self.owner))
+
+    def release_session(self, recipient, used=None):
+        if used is None:
+            self.db.execute(
+                'DELETE FROM sessions WHERE recipient = ? AND owner = ?',
+                (recipient, self.owner))
+        else:
+            self.db.execute(
+                'DELETE FROM sessions WHERE recipient = ? AND owner = ? '
+                'AND touched <= ?', (recipient, self.owner, used))
+
+    def forward(self, owner, sender, recipient, content):
+        self.db.execute(
+            'INSERT INTO forwarded (owner, sender, recipient, content) '
+            'VALUES (?, ?, ?, ?)', (owner, sender, recipient, content))
+
+    def take_forwarded(self, submit):
+        rows = self.db.execute(
+            'SELECT id, sender, recipient, content FROM forwarded '
+            'WHERE owner = ? ORDER BY id', (self.owner,)).fetchall()
+        taken = []
+        try:
+            for id, sender, recipient, content in rows:
+                submit(sender, recipient, content)
+                taken.append(id)
+        except QueueFull:
+            pass
+        finally:
+            # Only this process takes messages forwarded to it, so those
+            # submitted can't have been taken in the meantime
+            if taken:
+                self.db.execute(
+                    'DELETE FROM forwarded WHERE id IN (%s)' %
+                    ', '.join('?' * len(taken)), taken)
+
+    def close(self):
+        """Close the connections opened by all threads of this process; any
+        later use opens new ones."""
+        pid = os.getpid()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+            self.generation += 1
+        for db_pid, db in connections:
+            # Connections inherited across a fork belong to the parent
+            if db_pid == pid:
+                db.close()
+
+
+def get_state(path=None, ttl=86400, max_size=100000, error_rate=0):
+    """Return a SQLiteState using the database at path, or a LocalState if
+    path is None. A non-zero error_rate (for a Bloom filter of message ids)
+    can only be used with a LocalState."""
+    if path:
+        if error_rate:
+            raise ValueError(
+                'a dedup error rate cannot be used with a state database')
+        return SQLiteState(path, ttl, max_size)
+    return LocalState(ttl, max_size, error_rate)
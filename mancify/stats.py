@@ -0,0 +1,73 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import threading
+from timeit import default_timer as timer
+
+
+class TranslationStats(object):
+    """Statistics of a single translation, filled in by translate(stats=...).
+
+    timings maps each stage of the translation (tokenize, tag, restructure,
+    substitute, phonemes, untokenize) to the wall time spent in it; phonemes
+    is the part of substitute spent applying phoneme rules to words missing
+    from the cache. counts maps names such as tokens, words, cache_hits,
+    cache_misses, word_substitutions, structure_matches and phoneme_matches
+    to counts.
+    """
+
+    __slots__ = ('timings', 'counts')
+
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def timed(self, stage, func, *args, **kwargs):
+        """Call func(*args, **kwargs), adding its wall time to stage."""
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add_time(stage, timer() - start)
+
+    def as_dict(self):
+        return {'timings': dict(self.timings), 'counts': dict(self.counts)}
+
+
+class StatsAggregator(object):
+    """Thread-safe totals of the TranslationStats of many translations."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.timings = {}
+        self.counts = {}
+
+    def add(self, stats):
+        with self.lock:
+            self.calls += 1
+            for stage, seconds in stats.timings.items():
+                self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+            for name, n in stats.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'calls':   self.calls,
+                'timings': dict(self.timings),
+                'counts':  dict(self.counts),
+                }
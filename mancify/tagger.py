@@ -0,0 +1,198 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import io
+import os
+import json
+import threading
+from collections import defaultdict, Counter
+
+
+# Determine the location of the current module on the filesystem
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+# The default location of the lexicon, overridden by MANCIFY_LEXICON
+DEFAULT_LEXICON_PATH = os.path.join(HERE, 'lexicon.json')
+
+
+class Tagger(object):
+    """Base class of part-of-speech tagger backends.
+
+    A backend tags a list of tokens, returning a list of (token, tag) tuples
+    using the Penn Treebank tagset, as nltk.pos_tag does.
+    """
+
+    def tag(self, tokens):
+        raise NotImplementedError
+
+    def tag_many(self, token_lists):
+        """Tag a list of token lists."""
+        return [self.tag(tokens) for tokens in token_lists]
+
+
+class NLTKTagger(Tagger):
+    """NLTK's recommended tagger. Accurate but slow."""
+
+    def tag(self, tokens):
+        import nltk
+        return nltk.pos_tag(tokens)
+
+    def tag_many(self, token_lists):
+        import nltk
+        # NLTK 3 renamed batch_pos_tag
+        pos_tag_sents = getattr(nltk, 'pos_tag_sents', None) or nltk.batch_pos_tag
+        return pos_tag_sents(token_lists)
+
+
+class LexiconTagger(Tagger):
+    """A fast tagger which looks each token up in a lexicon of the most
+    frequent tag of every word in a tagged corpus, falling back to the most
+    frequent tag of the word's suffix.
+
+    It ignores context so is far less accurate than NLTK's tagger, but
+    distinguishes the coarse classes dialect structure rules match on (nouns,
+    adjectives, punctuation) well enough.
+    """
+
+    def __init__(self, lexicon, suffixes, max_suffix=3):
+        self.lexicon = lexicon
+        self.suffixes = suffixes
+        self.max_suffix = max_suffix
+
+    @classmethod
+    def train(cls, tagged_sents, max_suffix=3, min_count=2):
+        """Build a LexiconTagger from an iterable of tagged sentences (lists
+        of (word, tag) tuples)."""
+        words = defaultdict(Counter)
+        suffixes = defaultdict(Counter)
+        for sentence in tagged_sents:
+            for word, tag in sentence:
+                # Skip the traces and empty elements of treebank corpora
+                if tag == '-NONE-':
+                    continue
+                words[word.lower()][tag] += 1
+                if word.isalpha():
+                    for size in range(1, max_suffix + 1):
+                        if len(word) > size:
+                            suffixes[word[-size:].lower()][tag] += 1
+        return cls(
+            dict(
+                (word, tags.most_common(1)[0][0])
+                for word, tags in words.items()
+                ),
+            dict(
+                (suffix, tags.most_common(1)[0][0])
+                for suffix, tags in suffixes.items()
+                if sum(tags.values()) >= min_count
+                ),
+            max_suffix)
+
+    @classmethod
+    def load(cls, path):
+        with io.open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['lexicon'], data['suffixes'], data['max_suffix'])
+
+    def save(self, path):
+        data = json.dumps({
+            'lexicon': self.lexicon,
+            'suffixes': self.suffixes,
+            'max_suffix': self.max_suffix,
+            }, ensure_ascii=False)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(str(data))
+
+    def tag(self, tokens):
+        return [(token, self.tag_word(token, i)) for i, token in enumerate(tokens)]
+
+    def tag_word(self, word, position=0):
+        """Return the tag of word at the given position in a sentence."""
+        word_lower = word.lower()
+        try:
+            return self.lexicon[word_lower]
+        except KeyError:
+            pass
+        if not any(c.isalnum() for c in word):
+            return '.' if word[-1] in '.!?' else ':'
+        if any(c.isdigit() for c in word):
+            return 'CD'
+        if position and word[0].isupper():
+            return 'NNP'
+        for size in range(min(self.max_suffix, len(word) - 1), 0, -1):
+            try:
+                return self.suffixes[word_lower[-size:]]
+            except KeyError:
+                pass
+        return 'NN'
+
+
+def lexicon_path():
+    """Return the path of the lexicon used by the "lexicon" backend."""
+    return os.environ.get('MANCIFY_LEXICON', DEFAULT_LEXICON_PATH)
+
+
+def _load_lexicon_tagger():
+    return LexiconTagger.load(lexicon_path())
+
+
+# Factories of the available backends by name
+backends = {
+    'nltk':    NLTKTagger,
+    'lexicon': _load_lexicon_tagger,
+    }
+
+# The backend used for dialects that don't name one, overridden by
+# MANCIFY_TAGGER
+default_backend = os.environ.get('MANCIFY_TAGGER', 'nltk')
+
+_taggers = {}
+_taggers_lock = threading.Lock()
+
+
+def get_tagger(name=None):
+    """Return the tagger backend called name, or the default backend."""
+    if name is None:
+        name = default_backend
+    try:
+        return _taggers[name]
+    except KeyError:
+        pass
+    with _taggers_lock:
+        if name not in _taggers:
+            try:
+                factory = backends[name]
+            except KeyError:
+                raise ValueError('Unknown tagger backend %s' % name)
+            _taggers[name] = factory()
+        return _taggers[name]
+
+
+def dialect_tagger(dialect):
+    """Return the tagger backend for dialect.
+
+    A dialect may name its backend with a tagger attribute, otherwise the
+    default backend is used.
+    """
+    return get_tagger(getattr(dialect, 'tagger', None))
+
+
+def main():
+    """Entry point to build the lexicon from NLTK's tagged treebank corpus."""
+    import sys
+    from nltk.corpus import treebank
+    path = sys.argv[1] if len(sys.argv) > 1 else lexicon_path()
+    tagger = LexiconTagger.train(treebank.tagged_sents())
+    tagger.save(path)
+    print('Wrote %d words and %d suffixes to %s' % (
+        len(tagger.lexicon), len(tagger.suffixes), path))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,6 @@ str = type('')
 
 import sys
 import os
-import re
 import argparse
 import ConfigParser
 import logging
@@ -18,11 +17,11 @@ import locale
 import curses
 import curses.ascii
 import curses.textpad
-from itertools import izip_longest
 from wsgiref.simple_server import make_server
 
-from mancify import __version__
-from mancify.translator import translate
+from mancify import __version__, tagger
+from mancify.translator import IncrementalTranslation, preload
+from mancify.sms import SMS_LIMIT
 from mancify.wsgi import MancifyWsgiApp
 
 
@@ -124,7 +123,7 @@ class BaseConsoleApp(object):
             self.parser.set_defaults(**{
                 key:
                 config.getboolean(section, key)
-                if key in ('pdb',) else
+                if key in ('pdb', 'stats', 'result_cache') else
                 config.get(section, key)
                 for key in (
                     'pdb',
@@ -133,6 +132,26 @@ class BaseConsoleApp(object):
                     'exec_timeout',
                     'connect_timeout',
                     'session_timeout',
+                    'max_sessions',
+                    'phoneme_cache_size',
+                    'tagger',
+                    'stats',
+                    'result_cache',
+                    'result_cache_size',
+                    'result_cache_bytes',
+                    'result_cache_ttl',
+                    'workers',
+                    'queue_size',
+                    'ssh_workers',
+                    'ssh_queue_size',
+                    'sms_workers',
+                    'sms_queue_size',
+                    'sms_retries',
+                    'sms_limit',
+                    'dedup_ttl',
+                    'dedup_size',
+                    'dedup_error_rate',
+                    'state_db',
                     'clockwork_api_key',
                     )
                 if config.has_option(section, key)
@@ -161,7 +180,7 @@ class MancifyCursesApp(BaseConsoleApp):
         super(MancifyCursesApp, self).__init__()
 
     def main(self, args):
-        translate('')
+        preload()
         curses.wrapper(self.event_loop)
 
     def event_loop(self, screen):
@@ -169,33 +188,31 @@ class MancifyCursesApp(BaseConsoleApp):
         in_win = screen.subwin(y // 2, x, 0, 0)
         out_win = screen.subwin(y // 2 - 1, x, y // 2 + 1, 0)
         in_box = curses.textpad.Textbox(in_win)
-        old_content = []
-        new_content = []
-        content = []
+        translation = IncrementalTranslation()
         while True:
             c = in_win.getch()
             in_box.do_command(c)
             pos = in_win.getyx()
-            old_content = content
-            new_content = [(word, None) for word in re.split(r'(\s+)', in_box.gather().replace('\n', ' '))]
-            content = []
-            for (old_word, new_word) in izip_longest(old_content, new_content):
-                if new_word is None:
-                    pass
-                elif (old_word is None) or (old_word[0] != new_word[0]):
-                    if not new_word[0]:
-                        pass
-                    elif re.match('\s+', new_word[0]):
-                        content.append((new_word[0], new_word[0]))
-                    else:
-                        content.append((new_word[0], translate(new_word[0])))
-                else:
-                    content.append(old_word)
-            out_win.clear()
-            out_win.addstr(0, 0, ''.join(t for (w, t) in content))
+            damage = translation.update(in_box.gather().replace('\n', ' '))
+            if damage:
+                self.redraw(out_win, translation.translation, *damage)
             in_win.move(*pos)
             out_win.refresh()
 
+    def redraw(self, out_win, text, start, old_stop, new_stop):
+        # Only redraw the damaged region of the output, unless its length
+        # changed in which case everything after it has moved too
+        height, width = out_win.getmaxyx()
+        # Writing to the bottom-right cell fails, so stop short of it
+        size = height * width - 1
+        stop = new_stop if new_stop == old_stop else len(text)
+        if start >= size:
+            return
+        out_win.move(*divmod(start, width))
+        out_win.addstr(text[start:min(stop, size)])
+        if stop == len(text):
+            out_win.clrtobot()
+
 
 class MancifyConsoleApp(BaseConsoleApp):
     def __init__(self):
@@ -224,10 +241,110 @@ class MancifyConsoleApp(BaseConsoleApp):
             '--session-timeout', dest='session_timeout', action='store',
             default=300, metavar='SECS', type=int,
             help='the timeout between SSH commands')
+        self.parser.add_argument(
+            '--max-sessions', dest='max_sessions', action='store', default=0,
+            metavar='NUM', type=int,
+            help='the maximum number of SSH sessions; when exceeded the least '
+            'recently used session is closed. Default: unlimited')
         self.parser.add_argument(
             '--output-limit', dest='output_limit', action='store',
             default=1024, metavar='BYTES', type=int,
             help='the maximum size of output to permit per command')
+        self.parser.add_argument(
+            '--phoneme-cache-size', dest='phoneme_cache_size', action='store',
+            default=10000, metavar='WORDS', type=int,
+            help='the maximum number of translated words to cache')
+        self.parser.add_argument(
+            '--tagger', dest='tagger', action='store', default=None,
+            choices=sorted(tagger.backends),
+            help='the part-of-speech tagger backend for dialects that do not '
+            'specify one. Default: %s' % tagger.default_backend)
+        self.parser.add_argument(
+            '--stats', dest='stats', action='store_true', default=False,
+            help='collect per-stage timings of translations, reported at '
+            '/stats')
+        self.parser.add_argument(
+            '--result-cache', dest='result_cache', action='store_true',
+            default=False,
+            help='answer repeated messages, and repeated SSH output, with '
+            'the cached translation instead of a fresh one (which may vary)')
+        self.parser.add_argument(
+            '--result-cache-size', dest='result_cache_size', action='store',
+            default=1000, metavar='NUM', type=int,
+            help='the maximum number of cached translations. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--result-cache-bytes', dest='result_cache_bytes', action='store',
+            default=1048576, metavar='BYTES', type=int,
+            help='the maximum total size of cached translations. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--result-cache-ttl', dest='result_cache_ttl', action='store',
+            default=3600, metavar='SECS', type=int,
+            help='how long to cache translations. Default: %(default)s')
+        self.parser.add_argument(
+            '--workers', dest='workers', action='store', default=4,
+            metavar='NUM', type=int,
+            help='the number of background threads translating messages. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--queue-size', dest='queue_size', action='store', default=100,
+            metavar='NUM', type=int,
+            help='the maximum number of messages waiting to be translated; '
+            'further messages are refused until the queue drains. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--ssh-workers', dest='ssh_workers', action='store', default=4,
+            metavar='NUM', type=int,
+            help='the number of background threads running SSH commands. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--ssh-queue-size', dest='ssh_queue_size', action='store',
+            default=100, metavar='NUM', type=int,
+            help='the maximum number of SSH commands waiting to be run. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--sms-workers', dest='sms_workers', action='store', default=2,
+            metavar='NUM', type=int,
+            help='the number of background threads sending SMS replies. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--sms-queue-size', dest='sms_queue_size', action='store',
+            default=1000, metavar='NUM', type=int,
+            help='the maximum number of SMS chunks waiting to be sent. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--sms-retries', dest='sms_retries', action='store', default=3,
+            metavar='NUM', type=int,
+            help='the number of times to retry sending a failed SMS, backing '
+            'off exponentially. Default: %(default)s')
+        self.parser.add_argument(
+            '--sms-limit', dest='sms_limit', action='store',
+            default=SMS_LIMIT, metavar='CHARS', type=int,
+            help='the maximum length of each reply, beyond which it is cut '
+            'short with "..."; 0 for no limit. Default: %(default)s')
+        self.parser.add_argument(
+            '--dedup-ttl', dest='dedup_ttl', action='store', default=86400,
+            metavar='SECS', type=int,
+            help='how long to remember message ids to ignore retries of '
+            'messages already received. Default: %(default)s')
+        self.parser.add_argument(
+            '--dedup-size', dest='dedup_size', action='store', default=100000,
+            metavar='NUM', type=int,
+            help='the maximum number of message ids to remember. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--dedup-error-rate', dest='dedup_error_rate', action='store',
+            default=0.0, metavar='RATE', type=float,
+            help='if non-zero, remember message ids in a fixed size Bloom '
+            'filter which wrongly ignores up to this fraction of new messages. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--state-db', dest='state_db', action='store', default=None,
+            metavar='FILE',
+            help='share the ids of messages received and the owners of SSH '
+            'sessions with other server processes through the SQLite '
+            'database FILE. Use this when running several worker processes')
         self.parser.add_argument(
             '--clockwork-api-key', dest='clockwork_api_key', action='store',
             metavar='KEY', default=None,
@@ -1,8 +1,25 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from itertools import chain
 
 from . import translator
-from .pronunciation import pronounce
+from . import rules
+from . import cache
+from . import snapshot
+from . import tagger
+from . import stats
+from . import sms
+from . import dedup
+from . import state
+from . import ssh
+from . import workers
+from .pronunciation import pronounce, align, Phoneme
+from . import dialects
 from .dialects import manc
 
 
@@ -20,6 +37,71 @@ class TestMancify(unittest.TestCase):
         self.assertIn(translator.translate('bad'), replacements)
         self.assertIn(translator.translate('poor'), replacements)
 
+    def testRestructureNoRules(self):
+        from .dialects import normal
+        tokens = ['Hello', ',', 'world']
+        self.assertEqual(tokens, translator.restructure(tokens, normal))
+
+    def testTranslateMany(self):
+        texts = ['Hello, my friend!', '', 'This is really bad.\nThe house is good.']
+        expected = [
+            translator.translate(text, manc, translator.derive_seed(42, i))
+            for i, text in enumerate(texts)]
+        self.assertEqual(expected, translator.translate_many(texts, manc, seed=42))
+
+    def testDeriveSeed(self):
+        # Derived seeds must be the same on every platform
+        self.assertEqual(None, translator.derive_seed(None, 0))
+        self.assertEqual(13827901451692186954, translator.derive_seed(42, 0))
+        self.assertEqual(16471265717938153006, translator.derive_seed(42, 1))
+
+    def testTranslateThreadSafe(self):
+        import threading
+        text = 'Hello, my friend! This is really good. The house is bad.'
+        expected = [translator.translate(text, manc, seed) for seed in range(20)]
+        results = [None] * 20
+        def worker(seed):
+            results[seed] = translator.translate(text, manc, seed)
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(expected, results)
+
+    def testTranslateRng(self):
+        import random
+        text = 'Hello, my friend! This is really good.'
+        self.assertEqual(
+            translator.translate(text, manc, seed=1),
+            translator.translate(text, manc, rng=random.Random(1)))
+
+    def testLineBlocks(self):
+        lines = ['One line\n', 'and more.\n', '\n', 'a\n', 'b\n', 'c\n', 'd']
+        self.assertEqual(
+            [['One line\n', 'and more.\n'], ['\n'], ['a\n', 'b\n'], ['c\n', 'd']],
+            list(translator.line_blocks(lines, block_size=2)))
+
+    def testTranslateStream(self):
+        from .dialects import normal
+        lines = ['Hello, my friend!\n', '\n', 'This is good\n', 'and bad.']
+        self.assertEqual(
+            ''.join(lines), ''.join(translator.translate_stream(lines, normal)))
+        expected = [
+            translator.translate_block(block, manc, translator.derive_seed(7, i))
+            for i, block in enumerate(translator.line_blocks(lines))]
+        self.assertEqual(expected, list(translator.translate_stream(lines, manc, seed=7)))
+
+    def testTranslateBlocks(self):
+        lines = ['Hello, my friend!\n', 'This is good.\n', 'And bad.\n']
+        blocks = list(enumerate(translator.line_blocks(lines, block_size=1)))
+        self.assertEqual(
+            list(translator.translate_stream(lines, manc, seed=3, block_size=1)),
+            list(translator.translate_blocks(blocks, manc, seed=3)))
+        self.assertEqual(
+            list(translator.translate_blocks(blocks, manc, seed=3)),
+            list(translator.translate_blocks(blocks, manc, seed=3, jobs=2, window=1)))
+
     def testSpacer(self):
         # Check whitespace is maintained
         text = 'This is a very, very good test!\nLine two. And again!'
@@ -38,6 +120,49 @@ class TestMancify(unittest.TestCase):
         self.assertEqual('How Do', translator.match_case('how do', 'Sample Text'))
 
 
+class TestIncrementalTranslation(unittest.TestCase):
+    def setUp(self):
+        self.translation = translator.IncrementalTranslation(manc, seed=1)
+        self.words = []
+        translate_word = self.translation.translate_word
+        def counting_translate_word(word):
+            self.words.append(word)
+            return translate_word(word)
+        self.translation.translate_word = counting_translate_word
+
+    def check(self, text):
+        old = self.translation.translation
+        damage = self.translation.update(text)
+        new = self.translation.translation
+        self.assertEqual(text, ''.join(s for s, t in self.translation.tokens))
+        start, old_stop, new_stop = damage
+        self.assertEqual(old[:start], new[:start])
+        self.assertEqual(old[old_stop:], new[new_stop:])
+        return damage
+
+    def testUpdate(self):
+        self.check('hello my friend')
+        self.assertEqual(['hello', ' ', 'my', ' ', 'friend'], self.words)
+        del self.words[:]
+        self.check('hello my friend this')
+        self.assertEqual(['friend', ' ', 'this'], self.words)
+        del self.words[:]
+        self.check('hello my friendthis')
+        self.assertEqual(['friendthis'], self.words)
+        del self.words[:]
+        self.check('hello, my friendthis')
+        self.assertEqual(['hello,', ' '], self.words)
+        self.assertEqual(None, self.translation.update('hello, my friendthis'))
+        self.check('')
+        self.assertEqual([], self.translation.tokens)
+
+    def testCommonAffixes(self):
+        self.assertEqual(3, translator.common_prefix('abcd', 'abcx'))
+        self.assertEqual(0, translator.common_prefix('', 'abc'))
+        self.assertEqual(2, translator.common_suffix('abcd', 'xbcd', 2))
+        self.assertEqual(3, translator.common_suffix('abcd', 'xbcd', 4))
+
+
 class TestPronunciation(unittest.TestCase):
 
     def _test_pronunciations(self, tests):
@@ -183,3 +308,1106 @@ class TestPhonemeMatch(unittest.TestCase):
     def testMatchEnd(self):
         self.assertTrue(translator.match_phoneme(self.hat, 4, ['END']))
         self.assertFalse(translator.match_phoneme(self.hat, 3, ['END']))
+
+
+class TestPhonemeMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = rules.PhonemeMatcher(manc.phoneme_rules)
+
+    def _graphemes(self, phons):
+        return ''.join(p.grapheme for p in self.matcher.apply(phons))
+
+    def testInterning(self):
+        table = rules.PhonemeTable()
+        self.assertEqual(0, table.intern(''))
+        self.assertEqual(table.intern('AE1'), table.intern('AE1'))
+        self.assertEqual(table.intern('AE'), table.bases[table.intern('AE1')])
+        self.assertTrue(table.vowels[table.intern('AE1')])
+        self.assertFalse(table.vowels[table.intern('T')])
+
+    def testApply(self):
+        hat = [Phoneme('HH', 'h'), Phoneme('AE1', 'a'), Phoneme('T', 't')]
+        self.assertEqual("'a'", self._graphemes(hat))
+        self.assertEqual(
+            [("'", "'"), ('AE1', 'a'), ("'", "'")], self.matcher.apply(hat))
+
+    def testVowelConsonantMarkers(self):
+        # 'T' between two vowels becomes 'R' with its neighbours retained
+        butter = [Phoneme('B', 'b'), Phoneme('AH1', 'u'), Phoneme('T', 'tt'), Phoneme('ER0', 'er')]
+        self.assertEqual("booro'", self._graphemes(butter))
+
+    def testUnpronounced(self):
+        # Unpronounced letters never match a rule
+        home = [Phoneme('HH', 'h'), Phoneme('OW1', 'o'), Phoneme('M', 'm'), Phoneme('', 'e')]
+        self.assertEqual("'ome", self._graphemes(home))
+
+    def testAlterPhonemes(self):
+        self.assertEqual("'a'", translator.alter_phonemes('hat', manc))
+        self.assertEqual('xyzzy', translator.alter_phonemes('xyzzy', manc))
+
+
+class TestStructureMatcher(unittest.TestCase):
+    def testTagPattern(self):
+        self.assertTrue(rules.tag_pattern('JJ*')('JJR'))
+        self.assertFalse(rules.tag_pattern('JJ*')('NN'))
+        self.assertTrue(rules.tag_pattern('NN')('NN'))
+        self.assertFalse(rules.tag_pattern('NN')('NNS'))
+        self.assertIs(rules.tag_pattern('NN'), rules.tag_pattern('NN'))
+
+    def testApply(self):
+        matcher = rules.StructureMatcher([
+            ((['JJ*', 'NN*'],), (['chuffing', 0, 1],), 1.0),
+            ((['END'],), (['init', 0],), 1.0),
+            ])
+        tagged = [('START', 'START'), ('red', 'JJ'), ('hat', 'NN'), ('END', 'END')]
+        self.assertEqual(
+            ['START', 'chuffing', 'red', 'hat', 'init', 'END'],
+            [word for word, tag in matcher.apply(tagged)])
+
+    def testFirstMatchOnly(self):
+        matcher = rules.StructureMatcher([((['NN'],), (['thing'],), 1.0)])
+        tagged = [('hat', 'NN'), ('cat', 'NN')]
+        self.assertEqual(
+            [('thing', '?'), ('cat', 'NN')], matcher.apply(tagged))
+
+    def testChance(self):
+        matcher = rules.StructureMatcher([((['NN'],), (['thing'],), 0.0)])
+        tagged = [('hat', 'NN')]
+        self.assertEqual([('hat', 'NN')], matcher.apply(tagged))
+
+
+class TestWordIndex(unittest.TestCase):
+    def testFirstRuleWins(self):
+        index = rules.WordIndex(manc.word_rules)
+        self.assertIn('chuffed', index.get('pleased'))
+        self.assertEqual(('knacker', 'bugger'), index.get('corrupt'))
+        self.assertIn('naff', index.get('awful'))
+        self.assertEqual(('ov',), index.get('of'))
+        self.assertIsNone(index.get('xyzzy'))
+
+    def testWildcard(self):
+        from .dialects import pikachu
+        index = rules.WordIndex(pikachu.word_rules)
+        self.assertIn('pika', index.get('anything'))
+
+    def testReplaceRandom(self):
+        self.assertEqual('ov', translator.replace_random('of', manc))
+        self.assertEqual('xyzzy', translator.replace_random('xyzzy', manc))
+
+
+class TestLRUCache(unittest.TestCase):
+    def testEviction(self):
+        lru = cache.LRUCache(capacity=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(1, lru.get('a'))
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(1, lru.get('a'))
+        self.assertEqual(3, lru.get('c'))
+        self.assertEqual(
+            {'size': 2, 'capacity': 2, 'hits': 3, 'misses': 1, 'evictions': 1},
+            lru.stats())
+
+    def testResize(self):
+        lru = cache.LRUCache(capacity=3)
+        for i in range(3):
+            lru.set(i, i)
+        lru.resize(1)
+        self.assertEqual(1, len(lru))
+        self.assertEqual(2, lru.get(2))
+        lru.resize(0)
+        lru.set('a', 1)
+        self.assertEqual(0, len(lru))
+
+    def testAlterPhonemesCached(self):
+        translator.phoneme_cache.clear()
+        translator.alter_phonemes('hat', manc)
+        self.assertEqual("'a'", translator.alter_phonemes('hat', manc))
+        stats = translator.phoneme_cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+
+class TestResultCache(unittest.TestCase):
+    def testBytes(self):
+        c = cache.ResultCache(capacity=10, max_bytes=10)
+        c.set('a', 'xxxx')
+        c.set('b', 'yyyy')
+        c.set('c', 'zzzz')
+        self.assertEqual(None, c.get('a'))
+        self.assertEqual('zzzz', c.get('c'))
+        self.assertEqual(8, c.stats()['bytes'])
+        self.assertEqual(2, c.stats()['entries'])
+        self.assertNotIn('size', c.stats())
+        c.set('d', 'x' * 11)
+        self.assertEqual(None, c.get('d'))
+        c.set('b', 'y')
+        self.assertEqual(5, c.stats()['bytes'])
+
+    def testTTL(self):
+        now = [1000.0]
+        c = cache.ResultCache(ttl=60)
+        c.clock = lambda: now[0]
+        c.set('a', 'xxxx')
+        now[0] += 59
+        self.assertEqual('xxxx', c.get('a'))
+        now[0] += 1
+        self.assertEqual(None, c.get('a'))
+        stats = c.stats()
+        self.assertEqual((1, 0, 1), (stats['expirations'], stats['bytes'], stats['hits']))
+
+    def testApp(self):
+        from . import wsgi
+        app = wsgi.MancifyWsgiApp(
+            clockwork_api_key='', preload=False, result_cache=True)
+        self.addCleanup(app.close)
+        text = 'Hello, my friend! This is really good.'
+        result = app.translate(text, manc)
+        for i in range(10):
+            self.assertEqual(result, app.translate(text, manc))
+        self.assertEqual(10, app.result_cache.stats()['hits'])
+
+    def testAppStats(self):
+        import json
+        from webob import Request
+        from . import wsgi
+        app = wsgi.MancifyWsgiApp(
+            clockwork_api_key='', preload=False, result_cache=True)
+        self.addCleanup(app.close)
+        # An empty cache is still reported
+        stats = json.loads(Request.blank('/stats').get_response(app).body)
+        self.assertEqual(0, stats['result_cache']['entries'])
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.entries = [
+            ('hat', [['HH', 'AE1', 'T']]),
+            ('assert', [['AH0', 'S', 'ER1', 'T']]),
+            ('the', [['DH', 'AH0'], ['DH', 'AH1']]),
+            ]
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'pronunciation.dat')
+        snapshot.build(self.path, self.entries)
+        self.snapshot = snapshot.load(self.path)
+
+    def tearDown(self):
+        self.snapshot.close()
+        shutil.rmtree(self.temp_dir)
+
+    def testLookup(self):
+        self.assertEqual(3, len(self.snapshot))
+        self.assertIn('hat', self.snapshot)
+        self.assertNotIn('cat', self.snapshot)
+        self.assertEqual([['DH', 'AH0']], self.snapshot['the'])
+        self.assertRaises(KeyError, lambda: self.snapshot['cat'])
+        self.assertEqual(None, self.snapshot.get('cat'))
+
+    def testIter(self):
+        self.assertEqual(['assert', 'hat', 'the'], list(self.snapshot))
+        self.assertEqual(['assert', 'hat', 'the'], self.snapshot.keys())
+
+    def testPronounce(self):
+        for word, pronunciations in self.entries:
+            self.assertListEqual(
+                align(word, pronunciations[0]), self.snapshot.pronounce(word))
+        self.assertRaises(KeyError, self.snapshot.pronounce, 'cat')
+
+    def testMissing(self):
+        self.assertIsNone(snapshot.load(os.path.join(self.temp_dir, 'missing.dat')))
+
+
+class TestLexiconTagger(unittest.TestCase):
+    def setUp(self):
+        self.tagger = tagger.LexiconTagger.train([
+            [('The', 'DT'), ('red', 'JJ'), ('house', 'NN'), ('.', '.')],
+            [('A', 'DT'), ('bigger', 'JJR'), ('mouse', 'NN'), ('runs', 'VBZ'), ('quickly', 'RB')],
+            [('Slowly', 'RB'), (',', ','), ('houses', 'NNS'), ('fell', 'VBD'), ('*-1', '-NONE-')],
+            ])
+
+    def testLexicon(self):
+        self.assertEqual(
+            [('the', 'DT'), ('red', 'JJ'), ('house', 'NN'), (',', ',')],
+            self.tagger.tag(['the', 'red', 'house', ',']))
+        self.assertNotIn('*-1', self.tagger.lexicon)
+
+    def testUnknown(self):
+        self.assertEqual('RB', self.tagger.tag_word('madly'))
+        self.assertEqual('CD', self.tagger.tag_word('42'))
+        self.assertEqual('NNP', self.tagger.tag_word('Manchester', 1))
+        self.assertEqual('.', self.tagger.tag_word('?!'))
+        self.assertEqual('NN', self.tagger.tag_word('zork'))
+
+    def testSaveLoad(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'lexicon.json')
+            self.tagger.save(path)
+            loaded = tagger.LexiconTagger.load(path)
+            self.assertEqual(self.tagger.lexicon, loaded.lexicon)
+            self.assertEqual(self.tagger.suffixes, loaded.suffixes)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testUnknownBackend(self):
+        self.assertRaises(ValueError, tagger.get_tagger, 'xyzzy')
+
+
+class TestDialect(unittest.TestCase):
+    def testCompiled(self):
+        dialect = dialects.get('manc')
+        self.assertIs(dialect, dialects.compiled(manc))
+        self.assertIs(dialect, dialects.compiled(dialect))
+        self.assertIsInstance(dialect.ignores, frozenset)
+        self.assertIn('be', dialect.ignores)
+        self.assertEqual(('ov',), dialect.word_index.get('of'))
+
+    def testWildcardIgnores(self):
+        self.assertIn('anything', dialects.get('normal').ignores)
+
+    def testImmutable(self):
+        dialect = dialects.get('manc')
+        self.assertRaises(AttributeError, setattr, dialect, 'ignores', frozenset())
+        self.assertRaises(AttributeError, setattr, dialect, 'foo', 1)
+
+    def testPickle(self):
+        import pickle
+        dialect = dialects.get('pikachu')
+        self.assertIs(dialect, pickle.loads(pickle.dumps(dialect)))
+
+    def testValidate(self):
+        from types import ModuleType
+        module = ModuleType(str('bad'))
+        module.ignores = []
+        module.word_rules = []
+        module.phoneme_rules = [((['T', 'END'],), [2, 'END'])]
+        module.structure_rules = []
+        self.assertRaises(ValueError, dialects.Dialect, module)
+        module.phoneme_rules = []
+        module.structure_rules = [((['NN'],), (['thing'],), 2)]
+        self.assertRaises(ValueError, dialects.Dialect, module)
+
+
+class TestTranslationStats(unittest.TestCase):
+    def testInstrumented(self):
+        text = 'Hello, my friend! This is really good. The house is bad.'
+        translation_stats = stats.TranslationStats()
+        self.assertEqual(
+            translator.translate(text, manc, seed=1),
+            translator.translate(text, manc, seed=1, stats=translation_stats))
+        self.assertEqual(
+            set(['tokenize', 'tag', 'restructure', 'substitute', 'untokenize']),
+            set(translation_stats.timings) - set(['phonemes']))
+        self.assertEqual(15, translation_stats.counts['tokens'])
+        self.assertEqual(11, translation_stats.counts['words'])
+        self.assertGreater(translation_stats.counts['word_substitutions'], 0)
+        self.assertGreater(
+            translation_stats.counts.get('cache_hits', 0) +
+            translation_stats.counts.get('cache_misses', 0), 0)
+
+    def testAggregator(self):
+        aggregator = stats.StatsAggregator()
+        for i in range(2):
+            translation_stats = stats.TranslationStats()
+            translation_stats.add_time('tokenize', 0.5)
+            translation_stats.count('tokens', 3)
+            aggregator.add(translation_stats)
+        self.assertEqual(
+            {'calls': 2, 'timings': {'tokenize': 1.0}, 'counts': {'tokens': 6}},
+            aggregator.as_dict())
+
+
+class TestWorkerPool(unittest.TestCase):
+    def testSubmit(self):
+        pool = workers.WorkerPool(2, 10)
+        results = []
+        try:
+            for i in range(5):
+                pool.submit(results.append, i)
+            pool.submit(lambda: 1 // 0)
+            pool.queue.join()
+            stats = pool.stats()
+        finally:
+            pool.close()
+        self.assertEqual([0, 1, 2, 3, 4], sorted(results))
+        self.assertEqual(6, stats['processed'])
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(0, stats['depth'])
+
+    def testQueueFull(self):
+        pool = workers.WorkerPool(1, 1)
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait()
+        try:
+            pool.submit(block)
+            started.wait()
+            pool.submit(block)
+            self.assertEqual(1, pool.stats()['depth'])
+            with self.assertRaises(workers.QueueFull):
+                pool.submit(block)
+        finally:
+            release.set()
+            pool.close()
+
+
+    def testCloseFull(self):
+        # Queued calls are finished before the pool closes
+        pool = workers.WorkerPool(1, 1)
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+        def block():
+            started.set()
+            release.wait()
+        pool.submit(block)
+        started.wait(1)
+        pool.submit(results.append, 1)
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        start = time.time()
+        pool.close(timeout=2)
+        timer.join()
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(pool.threads[0].is_alive())
+        self.assertEqual([1], results)
+        self.assertEqual(0, pool.stats()['discarded'])
+        self.assertTrue(pool.full())
+        with self.assertRaises(workers.QueueFull):
+            pool.submit(results.append, 2)
+
+    def testCloseTimeout(self):
+        # Calls still queued when the timeout expires are discarded
+        pool = workers.WorkerPool(1, 2)
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+        def block():
+            started.set()
+            release.wait()
+        pool.submit(block)
+        started.wait(1)
+        pool.submit(results.append, 1)
+        try:
+            start = time.time()
+            pool.close(timeout=0.2)
+            self.assertLess(time.time() - start, 1)
+        finally:
+            release.set()
+        pool.threads[0].join(1)
+        self.assertFalse(pool.threads[0].is_alive())
+        self.assertEqual([], results)
+        self.assertEqual(1, pool.stats()['discarded'])
+
+
+class TestSerialQueues(unittest.TestCase):
+    def testOrder(self):
+        pool = workers.WorkerPool(4, 100)
+        queues = workers.SerialQueues(pool, 100)
+        results = {'alice': [], 'bob': []}
+        running = set()
+        overlaps = []
+        def run(key, i):
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+            time.sleep(0.001)
+            results[key].append(i)
+            running.discard(key)
+        try:
+            for i in range(20):
+                queues.submit('alice', run, 'alice', i)
+                queues.submit('bob', run, 'bob', i)
+            pool.queue.join()
+        finally:
+            pool.close()
+        self.assertEqual(list(range(20)), results['alice'])
+        self.assertEqual(list(range(20)), results['bob'])
+        self.assertEqual([], overlaps)
+        self.assertEqual({'keys': 0, 'backlog': 0, 'capacity': 100}, queues.stats())
+
+    def testBacklog(self):
+        pool = workers.WorkerPool(1, 10)
+        queues = workers.SerialQueues(pool, 2)
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait()
+        try:
+            queues.submit('alice', block)
+            started.wait(1)
+            queues.submit('alice', release.wait)
+            self.assertFalse(queues.full())
+            queues.submit('alice', release.wait)
+            self.assertTrue(queues.full())
+            with self.assertRaises(workers.QueueFull):
+                queues.submit('bob', release.wait)
+        finally:
+            release.set()
+            pool.close()
+
+
+class FakeSMSResponse(object):
+    def __init__(self, success):
+        self.success = success
+        self.error_code = None if success else 1
+        self.error_description = None if success else 'Failed'
+
+
+class FakeSMSService(object):
+    def __init__(self, failures=0, fail_recipients=()):
+        self.api = self
+        self.failures = failures
+        self.fail_recipients = set(fail_recipients)
+        self.batches = []
+
+    def format(self, content):
+        return content.split('|')
+
+    def message(self, sender, recipient, chunk):
+        return (recipient, chunk)
+
+    def send(self, messages):
+        self.batches.append(messages)
+        if self.failures:
+            self.failures -= 1
+            return [FakeSMSResponse(False) for message in messages]
+        responses = []
+        for recipient, chunk in messages:
+            responses.append(FakeSMSResponse(recipient not in self.fail_recipients))
+            self.fail_recipients.discard(recipient)
+        return responses
+
+
+class TestSMSSegments(unittest.TestCase):
+    def testNormalize(self):
+        self.assertEqual(
+            'a b\nc\r d\n \n\re',
+            sms.normalize('  a   b\r\n\n\nc\r d\r\n  \n\n\re \n'))
+
+    def testCountSegments(self):
+        self.assertEqual((1, True), sms.count_segments('a' * 160))
+        self.assertEqual((2, True), sms.count_segments('a' * 161))
+        self.assertEqual((1, True), sms.count_segments(u'\u20ac' * 80))
+        self.assertEqual((2, True), sms.count_segments(u'\u20ac' * 81))
+        self.assertEqual((1, False), sms.count_segments(u'\u0101' * 70))
+        self.assertEqual((2, False), sms.count_segments(u'\u0101' * 71))
+        # Extension characters aren't split across segments
+        self.assertEqual((1, True), sms.count_segments('a' * 152 + '{' * 4))
+        self.assertEqual((2, True), sms.count_segments('a' * 152 + '{' * 5))
+        self.assertEqual((3, True), sms.count_segments('a' * 152 + '{' * 77))
+
+    def testSingle(self):
+        self.assertEqual(['hello'], list(sms.segment('hello')))
+        self.assertEqual(['a' * 459], list(sms.segment('a' * 459)))
+        self.assertEqual([], list(sms.segment('')))
+
+    def testPages(self):
+        text = ' '.join(['word'] * 200)
+        chunks = list(sms.segment(text))
+        self.assertEqual(3, len(chunks))
+        for page, chunk in enumerate(chunks, 1):
+            self.assertTrue(chunk.startswith('p%d:\n' % page))
+            self.assertLessEqual(len(chunk), 459)
+            self.assertLessEqual(sms.count_segments(chunk)[0], 3)
+            self.assertFalse(chunk.endswith(' '))
+        self.assertEqual(
+            text, ' '.join(chunk.split('\n', 1)[1] for chunk in chunks))
+
+    def testUCS2Pages(self):
+        text = 'x' * 300 + u'\u0101' + 'x' * 300
+        chunks = list(sms.segment(text))
+        for chunk in chunks:
+            self.assertLessEqual(sms.count_segments(chunk)[0], 3)
+        self.assertEqual(
+            [4 + 300, 4 + 197, 4 + 104], [len(chunk) for chunk in chunks])
+
+    def testOutputLimit(self):
+        self.assertEqual(
+            ['abcdefg...'], list(sms.segment('abcdefghijklmnop', output_limit=10)))
+        chunks = list(sms.segment('x' * 2000, output_limit=1000))
+        self.assertEqual(3, len(chunks))
+        self.assertTrue(chunks[-1].endswith('...'))
+        self.assertEqual(1000, sum(len(chunk) - 4 for chunk in chunks))
+
+
+class TestSMSDispatcher(unittest.TestCase):
+    def testOrderAndBatching(self):
+        service = FakeSMSService()
+        dispatcher = sms.SMSDispatcher(service, workers=0, batch_size=10)
+        dispatcher.send('me', 'alice', 'a1|a2|a3')
+        dispatcher.send('me', 'bob', 'b1')
+        dispatcher.send('me', 'alice', 'a4')
+        self.assertEqual(5, dispatcher.stats()['depth'])
+        dispatcher.threads = [threading.Thread(target=dispatcher._run)]
+        dispatcher.threads[0].start()
+        dispatcher.close()
+        self.assertEqual(
+            [('alice', 'a1'), ('bob', 'b1')], service.batches[0])
+        self.assertEqual(
+            ['a1', 'a2', 'a3', 'a4'],
+            [chunk for batch in service.batches
+                for recipient, chunk in batch if recipient == 'alice'])
+        stats = dispatcher.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(5, stats['sent'])
+        self.assertEqual(4, stats['batches'])
+
+    def testRetry(self):
+        service = FakeSMSService(failures=2)
+        dispatcher = sms.SMSDispatcher(
+            service, workers=1, retries=3, backoff=0.01)
+        dispatcher.send('me', 'alice', 'a1|a2')
+        dispatcher.close()
+        self.assertEqual(
+            [[('alice', 'a1')]] * 3 + [[('alice', 'a2')]], service.batches)
+        stats = dispatcher.stats()
+        self.assertEqual((2, 2, 0), (stats['sent'], stats['retried'], stats['failed']))
+
+    def testRetryFailuresOnly(self):
+        service = FakeSMSService(fail_recipients=['bob'])
+        dispatcher = sms.SMSDispatcher(
+            service, workers=0, batch_size=10, retries=3, backoff=0.01)
+        dispatcher.send('me', 'alice', 'a1')
+        dispatcher.send('me', 'bob', 'b1')
+        dispatcher.threads = [threading.Thread(target=dispatcher._run)]
+        dispatcher.threads[0].start()
+        dispatcher.close()
+        self.assertEqual(
+            [[('alice', 'a1'), ('bob', 'b1')], [('bob', 'b1')]],
+            service.batches)
+        stats = dispatcher.stats()
+        self.assertEqual((2, 1, 0), (stats['sent'], stats['retried'], stats['failed']))
+
+    def testRetryError(self):
+        # When the API call raises, the whole batch is retried as it's
+        # unknown which chunks the gateway accepted
+        service = FakeSMSService()
+        send = service.send
+        def send_error(messages):
+            service.send = send
+            service.batches.append(messages)
+            raise IOError('Connection reset')
+        service.send = send_error
+        dispatcher = sms.SMSDispatcher(
+            service, workers=0, batch_size=10, retries=1, backoff=0.01)
+        dispatcher.send('me', 'alice', 'a1')
+        dispatcher.send('me', 'bob', 'b1')
+        dispatcher.threads = [threading.Thread(target=dispatcher._run)]
+        dispatcher.threads[0].start()
+        dispatcher.close()
+        self.assertEqual(
+            [[('alice', 'a1'), ('bob', 'b1')]] * 2, service.batches)
+        self.assertEqual(2, dispatcher.stats()['sent'])
+
+    def testGiveUp(self):
+        service = FakeSMSService(failures=10)
+        dispatcher = sms.SMSDispatcher(
+            service, workers=1, retries=1, backoff=0.01)
+        dispatcher.send('me', 'alice', 'a1')
+        dispatcher.close()
+        self.assertEqual(2, len(service.batches))
+        self.assertEqual(1, dispatcher.stats()['failed'])
+
+    def testQueueFull(self):
+        dispatcher = sms.SMSDispatcher(FakeSMSService(), workers=0, max_queue=2)
+        dispatcher.send('me', 'alice', 'a1|a2')
+        with self.assertRaises(workers.QueueFull):
+            dispatcher.send('me', 'bob', 'b1')
+
+
+class TestDedup(unittest.TestCase):
+    def testExpiringSet(self):
+        now = [1000.0]
+        messages = dedup.ExpiringSet(ttl=60, max_size=3)
+        messages.clock = lambda: now[0]
+        self.assertTrue(messages.add('a'))
+        self.assertFalse(messages.add('a'))
+        now[0] += 30
+        messages.add('b')
+        self.assertIn('a', messages)
+        now[0] += 31
+        self.assertNotIn('a', messages)
+        self.assertIn('b', messages)
+        for key in 'cde':
+            messages.add(key)
+        self.assertEqual(3, len(messages))
+        self.assertNotIn('b', messages)
+        messages.discard('e')
+        self.assertNotIn('e', messages)
+        self.assertTrue(messages.add('e'))
+
+    def testBloomFilter(self):
+        now = [1000.0]
+        messages = dedup.RotatingBloomFilter(
+            ttl=60, capacity=1000, error_rate=0.01)
+        messages.clock = lambda: now[0]
+        for i in range(1000):
+            messages.add('seen%d' % i)
+        for i in range(1000):
+            self.assertIn('seen%d' % i, messages)
+        false_positives = sum(
+            1 for i in range(10000) if 'unseen%d' % i in messages)
+        self.assertLess(false_positives, 200)
+        self.assertFalse(messages.add('seen0'))
+        now[0] += 130
+        self.assertNotIn('seen0', messages)
+
+    def testBloomFilterRotation(self):
+        now = [1000.0]
+        messages = dedup.RotatingBloomFilter(ttl=60, capacity=10)
+        messages.clock = lambda: now[0]
+        messages.add('a')
+        now[0] += 61
+        self.assertIn('a', messages)
+        now[0] += 61
+        self.assertNotIn('a', messages)
+
+    def testStore(self):
+        self.assertIsInstance(dedup.dedup_store(), dedup.ExpiringSet)
+        self.assertIsInstance(
+            dedup.dedup_store(error_rate=0.001), dedup.RotatingBloomFilter)
+        with self.assertRaises(ValueError):
+            dedup.RotatingBloomFilter(error_rate=1)
+
+
+class TestSQLiteState(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'state.db')
+        self.state = state.SQLiteState(self.path, ttl=60, max_size=2)
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.temp_dir)
+
+    def testClaimMessage(self):
+        other = state.SQLiteState(self.path)
+        try:
+            self.assertTrue(self.state.claim_message('AB_1'))
+            self.assertFalse(other.claim_message('AB_1'))
+            self.assertTrue(other.claim_message('AB_2'))
+        finally:
+            other.close()
+
+    def testReleaseMessage(self):
+        self.assertTrue(self.state.claim_message('AB_1'))
+        self.state.release_message('AB_1')
+        self.assertTrue(self.state.claim_message('AB_1'))
+
+    def testPrune(self):
+        for msg_id in ('AB_1', 'AB_2', 'AB_3'):
+            self.state.claim_message(msg_id)
+        self.state.prune()
+        self.assertTrue(self.state.claim_message('AB_1'))
+        self.assertFalse(self.state.claim_message('AB_3'))
+        self.state.prune(time.time() + 61)
+        self.assertTrue(self.state.claim_message('AB_3'))
+
+    def testSessions(self):
+        owner = self.state.owner
+        self.assertEqual(owner, self.state.claim_session('0123', 300))
+        # Pretend another (live) process owns the session
+        other = state.process_owner(os.getppid())
+        self.state.db.execute(
+            'UPDATE sessions SET owner = ? WHERE recipient = ?', (other, '0123'))
+        self.assertEqual(other, self.state.claim_session('0123', 300))
+        self.state.forward(other, 'me', '0123', 'ls')
+        self.assertEqual([], self.take_forwarded())
+        # Once the session has timed out it's taken over along with the
+        # messages forwarded to it
+        self.assertEqual(owner, self.state.claim_session('0123', -1))
+        self.assertEqual([('me', '0123', 'ls')], self.take_forwarded())
+        self.assertEqual([], self.take_forwarded())
+        self.state.release_session('0123')
+        self.assertEqual(0, self.state.db.execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0])
+
+    def take_forwarded(self, limit=None):
+        messages = []
+        def submit(*message):
+            if len(messages) == limit:
+                raise workers.QueueFull()
+            messages.append(message)
+        self.state.take_forwarded(submit)
+        return messages
+
+    def testReleaseSession(self):
+        owner = self.state.owner
+        self.state.claim_session('0123', 300)
+        used = time.time()
+        time.sleep(0.01)
+        # The session is claimed again (by a new session) after it was last
+        # used, so releasing the old one leaves it alone
+        self.state.claim_session('0123', 300)
+        self.state.release_session('0123', used)
+        self.assertEqual(owner, self.state.claim_session('0123', 300))
+        self.assertEqual(1, self.state.db.execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0])
+        self.state.release_session('0123', time.time())
+        self.assertEqual(0, self.state.db.execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0])
+
+    def testErrorRate(self):
+        with self.assertRaises(ValueError):
+            state.get_state(self.path, error_rate=0.001)
+
+    def testForwardedQueueFull(self):
+        owner = self.state.owner
+        for i in range(3):
+            self.state.forward(owner, 'me', '0123', 'c%d' % i)
+        self.assertEqual([('me', '0123', 'c0')], self.take_forwarded(1))
+        self.assertEqual(
+            [('me', '0123', 'c1'), ('me', '0123', 'c2')], self.take_forwarded())
+        self.assertEqual([], self.take_forwarded())
+
+    def testOwnerReused(self):
+        # A live process which isn't the owner, reusing the owner's pid
+        start = state.process_start_time(os.getppid())
+        if start is None:
+            self.skipTest('process start times unavailable')
+        self.assertTrue(state.process_alive(state.process_owner(os.getppid())))
+        other = '%d:%d' % (os.getppid(), start + 1)
+        self.assertFalse(state.process_alive(other))
+        self.state.claim_session('0123', 300)
+        self.state.db.execute(
+            'UPDATE sessions SET owner = ? WHERE recipient = ?', (other, '0123'))
+        self.assertEqual(self.state.owner, self.state.claim_session('0123', 300))
+
+    def testCloseAllThreads(self):
+        connections = []
+        def worker():
+            self.state.claim_message('AB_1')
+            connections.append(self.state.db)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        connections.append(self.state.db)
+        self.state.close()
+        for db in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                db.execute('SELECT 1')
+        # The state can still be used after closing
+        self.assertFalse(self.state.claim_message('AB_1'))
+
+    def testLocalState(self):
+        local = state.get_state()
+        self.assertFalse(local.shared)
+        self.assertTrue(local.claim_message('AB_1'))
+        self.assertFalse(local.claim_message('AB_1'))
+        self.assertEqual(local.owner, local.claim_session('0123', 300))
+        with self.assertRaises(AssertionError):
+            local.forward('1', 'me', '0123', 'ls')
+
+
+class FakeSSHSession(object):
+    def __init__(self, sms, sender, recipient, *args, **kwargs):
+        self.recipient = recipient
+        self.timestamp = None
+        self.closed = 0
+        self.commands = []
+
+    def execute(self, content):
+        self.commands.append(content)
+        if content == 'logout':
+            self.timestamp = None
+        elif content == 'block':
+            self.started.set()
+            self.release.wait()
+
+    def close(self, quiet=False):
+        self.closed += 1
+
+
+# The events used by FakeSSHSession's "block" command
+FakeSSHSession.started = threading.Event()
+FakeSSHSession.release = threading.Event()
+
+
+class TestSessionExpiry(unittest.TestCase):
+    def setUp(self):
+        from . import wsgi
+        self.wsgi = wsgi
+        self.session_class = wsgi.MancifySSHSession
+        wsgi.MancifySSHSession = FakeSSHSession
+
+    def tearDown(self):
+        self.wsgi.MancifySSHSession = self.session_class
+
+    def make_app(self, **kwargs):
+        app = self.wsgi.MancifyWsgiApp(
+            clockwork_api_key='', preload=False, **kwargs)
+        self.addCleanup(app.close)
+        return app
+
+    def testExpiry(self):
+        app = self.make_app(session_timeout=0.5)
+        app.process_ssh('me', 'alice', 'ssh')
+        session = app.sessions['alice']
+        time.sleep(0.3)
+        app.process_ssh('me', 'bob', 'ssh')
+        time.sleep(0.3)
+        self.assertNotIn('alice', app.sessions)
+        self.assertIn('bob', app.sessions)
+        self.assertEqual(1, session.closed)
+        time.sleep(0.4)
+        self.assertEqual({}, dict(app.sessions))
+
+    def testMaxSessions(self):
+        app = self.make_app(max_sessions=2)
+        for recipient in ('alice', 'bob', 'alice', 'carol'):
+            app.process_ssh('me', recipient, 'ls')
+        self.assertEqual(['alice', 'carol'], list(app.sessions))
+        self.assertEqual(['ls', 'ls'], app.sessions['alice'].commands)
+
+    def run_blocked(self, app, recipient):
+        # Start recipient's session running a command which blocks until
+        # FakeSSHSession.release is set
+        FakeSSHSession.started.clear()
+        FakeSSHSession.release.clear()
+        self.addCleanup(FakeSSHSession.release.set)
+        thread = threading.Thread(
+            target=app.process_ssh, args=('me', recipient, 'block'))
+        thread.start()
+        self.assertTrue(FakeSSHSession.started.wait(1))
+        return thread
+
+    def testMaxSessionsBusy(self):
+        app = self.make_app(max_sessions=1)
+        app.process_ssh('me', 'alice', 'ssh')
+        session = app.sessions['alice']
+        thread = self.run_blocked(app, 'alice')
+        # The only session is busy so it's closed once its command finishes
+        app.process_ssh('me', 'bob', 'ssh')
+        self.assertEqual(['bob'], list(app.sessions))
+        self.assertEqual(0, session.closed)
+        FakeSSHSession.release.set()
+        thread.join(1)
+        self.assertEqual(1, session.closed)
+        self.assertEqual(['ssh', 'block'], session.commands)
+        self.assertEqual(['bob'], list(app.sessions))
+
+    def testCloseReplacedSession(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        app = self.make_app(state_db=os.path.join(temp_dir, 'state.db'))
+        app.process_ssh('me', 'alice', 'ssh')
+        old = app.sessions.pop('alice')
+        # A new session is started for alice while the old one is closing
+        app.process_ssh('me', 'alice', 'ssh')
+        app.close_session('alice', old)
+        self.assertEqual(1, old.closed)
+        self.assertEqual(1, app.state.db.execute(
+            'SELECT COUNT(*) FROM sessions WHERE recipient = ?',
+            ('alice',)).fetchone()[0])
+        app.close_session('alice', app.sessions.pop('alice'))
+        self.assertEqual(0, app.state.db.execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0])
+
+    def testExpiryBusy(self):
+        app = self.make_app(session_timeout=0.2)
+        app.process_ssh('me', 'alice', 'ssh')
+        session = app.sessions['alice']
+        thread = self.run_blocked(app, 'alice')
+        time.sleep(0.4)
+        # The session expired but isn't closed until its command finishes
+        self.assertNotIn('alice', app.sessions)
+        self.assertEqual(0, session.closed)
+        FakeSSHSession.release.set()
+        thread.join(1)
+        self.assertEqual(1, session.closed)
+
+    def testMaxSessionsIdle(self):
+        app = self.make_app(max_sessions=2)
+        app.process_ssh('me', 'alice', 'ssh')
+        alice = app.sessions['alice']
+        thread = self.run_blocked(app, 'alice')
+        app.process_ssh('me', 'bob', 'ssh')
+        bob = app.sessions['bob']
+        # Alice's session is the least recently used but busy, so the idle
+        # session is evicted instead
+        app.process_ssh('me', 'carol', 'ssh')
+        self.assertEqual(['alice', 'carol'], list(app.sessions))
+        self.assertEqual((0, 1), (alice.closed, bob.closed))
+        FakeSSHSession.release.set()
+        thread.join(1)
+        self.assertEqual(0, alice.closed)
+
+    def testSeparatePools(self):
+        from webob import Request
+        app = self.make_app(ssh_workers=1, ssh_queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        translated = threading.Event()
+        def process_ssh(sender, recipient, content):
+            started.set()
+            release.wait()
+        app.process_ssh = process_ssh
+        app.process_translate = lambda sender, recipient, content: translated.set()
+        def get(path, msg_id):
+            return Request.blank(
+                path, POST={'msg_id': msg_id, 'from': 'alice', 'to': 'me',
+                'content': 'ls'}).get_response(app).status_int
+        try:
+            self.assertEqual(200, get('/ssh', '1'))
+            started.wait(1)
+            self.assertEqual(200, get('/ssh', '2'))
+            self.assertEqual(503, get('/ssh', '3'))
+            self.assertEqual(200, get('/translate', '4'))
+            self.assertTrue(translated.wait(1))
+        finally:
+            release.set()
+
+    def testForwardedOrder(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        app = self.make_app(
+            state_db=os.path.join(temp_dir, 'state.db'),
+            ssh_workers=1, ssh_queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        commands = []
+        threads = set()
+        def process_ssh(sender, recipient, content):
+            threads.add(threading.current_thread().name)
+            if content == 'c0':
+                started.set()
+                release.wait()
+            commands.append(content)
+        app.process_ssh = process_ssh
+        for i in range(5):
+            app.state.forward(app.state.owner, 'me', 'alice', 'c%d' % i)
+        try:
+            self.assertTrue(started.wait(1))
+            time.sleep(0.6)
+            # The commands which don't fit in the queue are left to wait in
+            # the state database
+            self.assertLessEqual(3, app.state.db.execute(
+                'SELECT COUNT(*) FROM forwarded').fetchone()[0])
+        finally:
+            release.set()
+        for i in range(40):
+            if len(commands) == 5:
+                break
+            time.sleep(0.05)
+        self.assertEqual(['c0', 'c1', 'c2', 'c3', 'c4'], commands)
+        # Forwarded commands are only run by the (single) SSH worker
+        self.assertEqual(set(['ssh-0']), threads)
+
+    def testEnqueueClosing(self):
+        from webob import Request
+        app = self.make_app()
+        # Pretend the pool started closing after the check for room
+        app.workers.closing.set()
+        app.workers.full = lambda: False
+        def post():
+            return Request.blank(
+                '/translate', POST={'msg_id': '1', 'from': 'alice', 'to': 'me',
+                'content': 'hello'}).get_response(app).status_int
+        self.assertEqual(503, post())
+        # The message wasn't recorded so it's accepted when retried
+        self.assertTrue(app.state.claim_message('1'))
+
+    def testEnqueueUnlocked(self):
+        from webob import Request
+        app = self.make_app()
+        translated = threading.Event()
+        app.process_translate = lambda sender, recipient, content: translated.set()
+        # Recording a message mustn't need the lock used for sessions
+        with app.lock:
+            self.assertEqual(200, Request.blank(
+                '/translate', POST={'msg_id': '1', 'from': 'alice', 'to': 'me',
+                'content': 'hello'}).get_response(app).status_int)
+        self.assertTrue(translated.wait(1))
+
+    def testTagger(self):
+        default_backend = tagger.default_backend
+        self.addCleanup(setattr, tagger, 'default_backend', default_backend)
+        # The default backend (from MANCIFY_TAGGER) is kept unless a tagger
+        # is given
+        tagger.default_backend = 'lexicon'
+        self.make_app(tagger=None)
+        self.assertEqual('lexicon', tagger.default_backend)
+        self.make_app(tagger='nltk')
+        self.assertEqual('nltk', tagger.default_backend)
+
+    def testLogout(self):
+        app = self.make_app()
+        app.process_ssh('me', 'alice', 'ssh')
+        app.process_ssh('me', 'alice', 'logout')
+        self.assertNotIn('alice', app.sessions)
+
+
+class FakeChannel(object):
+    def __init__(self, out, err):
+        self.out = out
+        self.err = err
+        self.eof_received = True
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.out)
+
+    def recv_stderr_ready(self):
+        return bool(self.err)
+
+    def recv(self, n):
+        data, self.out = self.out[:n], self.out[n:]
+        return data
+
+    def recv_stderr(self, n):
+        data, self.err = self.err[:n], self.err[n:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class TestSSHOutput(unittest.TestCase):
+    def setUp(self):
+        self.session = ssh.MancifySSHSession(None, 'me', 'alice', output_limit=10)
+
+    def testRead(self):
+        channel = FakeChannel(b'hello', b'oops')
+        self.assertEqual(
+            ('hello', 'oops', False), self.session.read_output(channel))
+        self.assertTrue(channel.closed)
+
+    def testTruncate(self):
+        channel = FakeChannel(b'x' * 100, b'')
+        self.assertEqual(
+            ('x' * 10, '', True), self.session.read_output(channel))
+        self.assertTrue(channel.closed)
+        self.assertEqual(90, len(channel.out))
+
+    def testTruncatedReply(self):
+        from . import wsgi
+        app = wsgi.MancifyWsgiApp(clockwork_api_key='', preload=False)
+        self.addCleanup(app.close)
+        replies = []
+        class FakeSMS(object):
+            def send(self, sender, recipient, content):
+                replies.append(content)
+        class FakeClient(object):
+            def exec_command(self, content, timeout):
+                stdout = FakeChannel(b'hello my friend\n' * 200, b'')
+                stdout.channel = stdout
+                return None, stdout, None
+        session = ssh.MancifySSHSession(FakeSMS(), 'me', 'alice')
+        session.client = FakeClient()
+        session.execute('ls')
+        # The note survives the paging of a reply longer than the output
+        self.assertLess(1024, len(replies[0]))
+        pages = list(app.sms.service.format(replies[0]))
+        self.assertLess(1, len(pages))
+        text = ' '.join(page.split('\n', 1)[1] for page in pages)
+        self.assertTrue(text.endswith('\n[output truncated at 1024 bytes]'))
+
+    def testExactLimit(self):
+        channel = FakeChannel(b'x' * 6, b'y' * 4)
+        self.assertEqual(
+            ('x' * 6, 'y' * 4, False), self.session.read_output(channel))
@@ -9,15 +9,18 @@ from __future__ import (
 str = type('')
 
 import logging
-from itertools import chain
+import hashlib
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
 import random
 import re
 
-import nltk
-from nltk.tokenize import wordpunct_tokenize
-from nltk.corpus import cmudict
-
+from . import pronunciation
 from .pronunciation import pronounce, grapheme, Phoneme
+from . import rules
+from . import tagger
+from .cache import LRUCache
+from . import dialects
 from .dialects import manc
 
 
@@ -25,48 +28,268 @@ from .dialects import manc
 match_digits = re.compile(r'\d')
 
 
-def translate(text, dialect=manc, seed=None):
-    """Translate from plain English to given dialect."""
-    random.seed(seed)
+# Split text into alphabetic and non-alphabetic runs. This is NLTK's
+# wordpunct_tokenize without the cost of importing NLTK
+wordpunct_tokenize = re.compile(
+    r'\w+|[^\w\s]+', re.UNICODE | re.MULTILINE | re.DOTALL).findall
+
+
+# Memo of alter_phonemes results keyed on (dialect, word, phonetic). Resize it
+# with phoneme_cache.resize() to suit the available memory
+phoneme_cache = LRUCache(capacity=10000)
+
+
+def translate(text, dialect=manc, seed=None, rng=None, stats=None):
+    """Translate from plain English to given dialect.
+
+    Random choices are made with rng, a random.Random instance, which defaults
+    to a new instance seeded with seed. Concurrent calls never share an RNG
+    unless one is explicitly given, so are safe and reproducible.
+
+    If stats is a stats.TranslationStats it is filled in with the time spent
+    in each stage of the translation and counts of tokens, cache hits and
+    rule matches. Without it, no timing is done at all.
+    """
+    dialect = dialects.compiled(dialect)
+    if rng is None:
+        rng = random.Random(seed)
+    if stats is not None:
+        return _translate_instrumented(text, dialect, rng, stats)
     tokens = tokenize(text)
-    restructured = restructure(tokens,dialect)
-    translated = substitute(restructured, dialect)
+    restructured = restructure(tokens, dialect, rng=rng)
+    translated = substitute(restructured, dialect, rng=rng)
     return untokenize(translated)
 
 
-def restructure(tokens, dialect):
-    """Rearrange the structure of the input based on the given dialect."""
-    tagged = [("START","START")] + nltk.pos_tag(tokens) + [("END","END")]
-    logging.debug("Tagged=%s", tagged)
-    for patterns,replacements,chance in dialect.structure_rules:
-        for pattern in patterns:
-            for i in range(len(tagged)):
-                if not pos_tag_match(tagged,i,pattern):
-                    continue
-                if random.random() >= chance:
-                    continue
-                replacement = random.choice(replacements)
-                new = tagged[:i]
-                for r in replacement:
-                    if type(r)==int:
-                        new += [tagged[i+r]]
-                    else:
-                        new += [(r,"?")]
-                new += tagged[i+len(pattern):]
-                tagged = new
-                break
+def _translate_instrumented(text, dialect, rng, stats):
+    tokens = stats.timed('tokenize', tokenize, text)
+    stats.count('tokens', len(tokens))
+    stats.count('words', sum(1 for token in tokens if any(c.isalnum() for c in token)))
+    tagged = None
+    if dialect.structure_rules:
+        tagged = stats.timed('tag', tagger.dialect_tagger(dialect).tag, tokens)
+    restructured = stats.timed(
+        'restructure', restructure, tokens, dialect, tagged, rng, stats)
+    translated = stats.timed(
+        'substitute', list, substitute(restructured, dialect, rng=rng, stats=stats))
+    return stats.timed('untokenize', untokenize, iter(translated))
+
+
+def translate_many(texts, dialect=manc, seed=None):
+    """Translate a sequence of texts from plain English to given dialect.
+
+    Texts are tagged as a batch and phonetic substitutions are shared across
+    the batch. The result for each text is the same as that of
+    translate(text, dialect, derive_seed(seed, index)).
+    """
+    dialect = dialects.compiled(dialect)
+    token_lists = [tokenize(text) for text in texts]
+    if dialect.structure_rules:
+        tagged_lists = tagger.dialect_tagger(dialect).tag_many(token_lists)
+    else:
+        tagged_lists = [None] * len(token_lists)
+    lookups = {}
+    rng = random.Random()
+    result = []
+    for index, (tokens, tagged) in enumerate(zip(token_lists, tagged_lists)):
+        if seed is not None:
+            rng.seed(derive_seed(seed, index))
+        restructured = restructure(tokens, dialect, tagged, rng)
+        translated = substitute(restructured, dialect, lookups, rng)
+        result.append(untokenize(translated))
+    return result
+
+
+def translate_stream(lines, dialect=manc, seed=None, block_size=50):
+    """Generator translating an iterable of lines (such as a file) from plain
+    English to given dialect a block at a time.
+
+    Lines are gathered into blocks by line_blocks() and each block is
+    translated as translate(block, dialect, derive_seed(seed, index)) would,
+    so memory use is bounded by block_size rather than the size of the input.
+    """
+    dialect = dialects.compiled(dialect)
+    for index, block in enumerate(line_blocks(lines, block_size)):
+        yield translate_block(block, dialect, derive_seed(seed, index))
+
+
+def translate_block(block, dialect=manc, seed=None):
+    """Translate a block of lines (as produced by line_blocks), keeping the
+    trailing line break of the block if it has one."""
+    text = ''.join(block)
+    result = translate(text, dialect, seed)
+    if text.endswith(('\n', '\r')):
+        result += '\n'
+    return result
+
+
+def line_blocks(lines, block_size=50):
+    """Generator grouping lines into lists of at most block_size lines.
 
+    A block ends early after a line that is blank or ends a sentence so that,
+    where the text allows, blocks break on sentence boundaries.
+    """
+    block = []
+    for line in lines:
+        block.append(line)
+        end = line.rstrip()
+        if len(block) >= block_size or not end or end[-1] in '.!?':
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def derive_seed(seed, index):
+    """Return the seed for the text at index of a batch translated with seed.
+
+    The seed is derived from a digest rather than hash() so that it's the
+    same on every platform and isn't affected by hash randomization.
+    """
+    if seed is None:
+        return None
+    digest = hashlib.sha1(('%s:%d' % (seed, index)).encode('utf-8'))
+    return int(digest.hexdigest()[:16], 16)
+
+
+class IncrementalTranslation(object):
+    """The word by word translation of a text which is edited repeatedly,
+    such as the contents of a text box.
+
+    The text is split into words and runs of whitespace, and tokens holds
+    (source, translation) pairs for them. When the text is updated only the
+    words in the edited region (and their immediate neighbours, which may
+    have merged with or split from them) are translated again.
+    """
+
+    split_re = re.compile(r'(\s+)')
+
+    def __init__(self, dialect=manc, seed=None):
+        self.dialect = dialects.compiled(dialect)
+        self.rng = random.Random(seed)
+        self.text = ''
+        self.tokens = []
+        # The offsets of the end of each token in the text and in the
+        # translation
+        self.ends = []
+        self.out_ends = []
+
+    @property
+    def translation(self):
+        return ''.join(translation for source, translation in self.tokens)
+
+    def translate_word(self, word):
+        if word.isspace():
+            return word
+        return translate(word, self.dialect, rng=self.rng)
+
+    def update(self, text):
+        """Change the text to text, returning a (start, old_stop, new_stop)
+        tuple giving the offsets in the translation of the region which
+        changed, which ended at old_stop before the update, or None if the
+        text is unchanged."""
+        old = self.text
+        if text == old:
+            return None
+        prefix = common_prefix(old, text)
+        suffix = common_suffix(old, text, min(len(old), len(text)) - prefix)
+        first = max(0, bisect_right(self.ends, prefix) - 1)
+        last = min(
+            len(self.tokens),
+            bisect_left(self.ends, len(old) - suffix) + 2)
+        start = self.ends[first - 1] if first else 0
+        old_stop = self.ends[last - 1] if last else 0
+        new_stop = old_stop + len(text) - len(old)
+        tokens = [
+            (source, self.translate_word(source))
+            for source in self.split_re.split(text[start:new_stop])
+            if source
+            ]
+        ends = []
+        out_ends = []
+        out_start = self.out_ends[first - 1] if first else 0
+        end = start
+        out_end = out_start
+        for source, translation in tokens:
+            end += len(source)
+            out_end += len(translation)
+            ends.append(end)
+            out_ends.append(out_end)
+        old_out_stop = self.out_ends[last - 1] if last else 0
+        self.text = text
+        self.tokens[first:last] = tokens
+        self.ends[first:last] = ends
+        self.ends[first + len(ends):] = [
+            e + len(text) - len(old) for e in self.ends[first + len(ends):]]
+        self.out_ends[first:last] = out_ends
+        self.out_ends[first + len(out_ends):] = [
+            e + out_end - old_out_stop
+            for e in self.out_ends[first + len(out_ends):]]
+        return out_start, old_out_stop, out_end
+
+
+def common_prefix(a, b):
+    """Return the length of the longest common prefix of a and b."""
+    lo, hi = 0, min(len(a), len(b))
+    # Binary search comparing slices, which is much quicker than comparing
+    # character by character in Python
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a, b, limit):
+    """Return the length of the longest common suffix of a and b, up to
+    limit."""
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def preload():
+    """Load the part-of-speech tagger and the pronunciation dictionary now.
+
+    All of these are otherwise loaded on first use, which is slow. Servers
+    should call this before accepting requests.
+    """
+    tagger.get_tagger().tag(['preload'])
+    tagger.dialect_tagger(dialects.compiled(manc)).tag(['preload'])
+    pronunciation.load()
+
+
+def restructure(tokens, dialect, tagged=None, rng=random, stats=None):
+    """Rearrange the structure of the input based on the given dialect.
+
+    If the part-of-speech tagged tokens are already known they may be given
+    as tagged, a list of (word, tag) tuples. Random choices are made with rng
+    and accepted rule matches are counted in stats, if given.
+    """
+    dialect = dialects.compiled(dialect)
+    if not dialect.structure_rules:
+        # Don't pay for tagging when there's nothing to restructure
+        return list(tokens)
+    if tagged is None:
+        tagged = tagger.dialect_tagger(dialect).tag(tokens)
+    tagged = [("START","START")] + tagged + [("END","END")]
+    logging.debug("Tagged=%s", tagged)
+    tagged = dialect.structure_matcher.apply(tagged, rng, stats)
     return [word for word,tag in tagged[1:-1]]
 
 
 def pos_tag_match(tagged,i,pattern):
-    for j,ptag in enumerate(pattern):
-        if i+j >= len(tagged):
-            return False
-        if not bool(re.match("^"+ptag.replace("*",".*")+"$",tagged[i+j][1])):
-            return False
-    return True
-    
+    if i + len(pattern) > len(tagged):
+        return False
+    return all(rules.tag_pattern(ptag)(tagged[i+j][1]) for j,ptag in enumerate(pattern))
+
 
 def match_phoneme(phons, i, pattern):
     """Match the given pattern from position i in a sequence of phonemes."""
@@ -91,7 +314,7 @@ def match_phoneme(phons, i, pattern):
     return True
 
 
-def substitute(tokens, dialect):
+def substitute(tokens, dialect, lookups=None, rng=random, stats=None):
     """Generator producing translated words for given tokens.
 
     Algorithm:
@@ -99,55 +322,80 @@ def substitute(tokens, dialect):
         2. If (1) fails, try phonetic substitution.
         3. If (2) fails, it's a symbol! Return as is...
 
+    If given, lookups is a dict in which phonetic substitutions are memoized,
+    to be shared between calls. Random choices are made with rng and
+    substitutions are counted in stats, if given.
     """
+    dialect = dialects.compiled(dialect)
     for token in tokens:
         token_lower = token.lower()
         if token_lower in dialect.ignores:
             yield token
             continue
-        substitution = replace_random(token_lower, dialect)
+        substitution = replace_random(token_lower, dialect, rng)
         if substitution == token_lower:
-            substitution = alter_phonemes(token_lower, dialect)
+            if lookups is None:
+                substitution = alter_phonemes(token_lower, dialect, stats=stats)
+            else:
+                try:
+                    substitution = lookups[token_lower]
+                except KeyError:
+                    substitution = lookups[token_lower] = alter_phonemes(
+                        token_lower, dialect, stats=stats)
+        elif stats is not None:
+            stats.count('word_substitutions')
 
         yield match_case(substitution, token)
 
 
-def alter_phonemes(word, dialect, phonetic=False):
+def alter_phonemes(word, dialect, phonetic=False, stats=None):
     """Apply the dialect's phoneme rules to a word.
     
     If phonetic=True, convert the spelling of the word to a purely phonetic one.
+
+    Results are memoized in phoneme_cache. Cache hits and misses, rule matches
+    and the time spent applying rules are recorded in stats, if given.
     """
+    dialect = dialects.compiled(dialect)
+    key = (dialect, word, phonetic)
+    result = phoneme_cache.get(key)
+    if result is None:
+        if stats is None:
+            result = _alter_phonemes(word, dialect, phonetic)
+        else:
+            stats.count('cache_misses')
+            result = stats.timed(
+                'phonemes', _alter_phonemes, word, dialect, phonetic, stats)
+        phoneme_cache.set(key, result)
+    elif stats is not None:
+        stats.count('cache_hits')
+    return result
+
+
+def _alter_phonemes(word, dialect, phonetic, stats=None):
     try:
         phons = pronounce(word)
     except KeyError:
         return word
 
     logging.debug('Phoneme In=[%s->%s]', word, phons)
-    phons = [("START", '')] + phons + [("END", '')]
-
-    for patterns, replacement in dialect.phoneme_rules:
-        for pattern in patterns:
-            for i in range(len(phons)):
-                if match_phoneme(phons,i,pattern):
-                    r = [phons[i+rfon] if type(rfon)==int else Phoneme(phoneme=rfon, grapheme=grapheme(rfon)) for rfon in replacement]
-                    phons = phons[:i] + r + phons[i+len(pattern):]
-
+    phons = dialect.phoneme_matcher.apply(phons, stats)
     logging.debug('Phoneme Out=[%s->%s]', word, phons)
-    return "".join((p.grapheme if not phonetic else grapheme(p.phoneme)) for p in phons[1:-1])
+    return "".join((p.grapheme if not phonetic else grapheme(p.phoneme)) for p in phons)
 
 
-def replace_random(word,dialect):
-    """Replace given word with a random alternative from given dialect.
+def replace_random(word, dialect, rng=random):
+    """Replace given word with a random alternative from given dialect,
+    chosen with rng.
 
     If a replacement word does not exist, return the original word.
 
     """
-    for patterns, replacements in dialect.word_rules:
-        if word in patterns:
-            return random.choice(replacements)
-
-    # No replacement found
-    return word
+    replacements = dialects.compiled(dialect).word_index.get(word)
+    if replacements is None:
+        # No replacement found
+        return word
+    return rng.choice(replacements)
 
 
 def tokenize(text):
@@ -197,11 +445,90 @@ def match_case(text, match_text):
         return text
 
 
-def main():
-    """Entry point to run the standalone translator on a file or on stdin."""
+def translate_blocks(blocks, dialect=manc, seed=None, jobs=1, window=64):
+    """Generator translating (index, block) tuples of lines in order.
+
+    Each block is translated with translate_block(block, dialect,
+    derive_seed(seed, index)) so the result doesn't depend on jobs. If jobs
+    is greater than 1, blocks are translated by a pool of that many worker
+    processes, window blocks per worker at a time.
+    """
+    dialect = dialects.compiled(dialect)
+    if jobs <= 1:
+        for index, block in blocks:
+            yield translate_block(block, dialect, derive_seed(seed, index))
+        return
+
+    import multiprocessing
+    # Load everything before forking so the workers share it
+    preload()
+    tasks = (
+        (block, dialect, derive_seed(seed, index))
+        for index, block in blocks
+        )
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Keep one window of blocks in flight while the previous one is
+        # written out, so only two windows are ever held in memory
+        pending = None
+        while True:
+            batch = list(islice(tasks, window * jobs))
+            queued = pool.map_async(_translate_task, batch, window) if batch else None
+            if pending is not None:
+                for result in pending.get():
+                    yield result
+            if queued is None:
+                break
+            pending = queued
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _translate_task(task):
+    block, dialect, seed = task
+    return translate_block(block, dialect, seed)
+
+
+def main(args=None):
+    """Entry point to run the standalone translator on files or on stdin."""
     import sys
-    f = sys.stdin if len(sys.argv) == 1 else open(sys.argv[1])
-    print(translate(f.read()))
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Translate files (or stdin) from plain English to Manc')
+    parser.add_argument(
+        'files', nargs='*', metavar='FILE',
+        help='the files to translate, in order. Default: stdin')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', action='store', default=1, type=int,
+        metavar='N', help='translate with N worker processes. Default: 1')
+    parser.add_argument(
+        '-s', '--seed', dest='seed', action='store', default=None, type=int,
+        help='seed the translation so it is reproducible; the output for '
+        'a given seed is the same for any number of jobs')
+    parser.add_argument(
+        '-t', '--tagger', dest='tagger', action='store', default=None,
+        choices=sorted(tagger.backends),
+        help='the part-of-speech tagger backend to use. Default: %s' %
+        tagger.default_backend)
+    args = parser.parse_args(args)
+    if args.tagger:
+        tagger.default_backend = args.tagger
+
+    def blocks():
+        if not args.files:
+            for index_block in enumerate(line_blocks(sys.stdin)):
+                yield index_block
+        for filename in args.files:
+            with open(filename) as f:
+                for index_block in enumerate(line_blocks(f)):
+                    yield index_block
+
+    for chunk in translate_blocks(blocks(), manc, args.seed, args.jobs):
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
 
 
 if __name__ == '__main__':
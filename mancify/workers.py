@@ -0,0 +1,188 @@
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+# Make Py2's str type like Py3's
+str = type('')
+
+import time
+import logging
+import threading
+import Queue
+from collections import deque
+
+
+# Raised by WorkerPool.submit when the pool's queue is full
+QueueFull = Queue.Full
+
+
+class WorkerPool(object):
+    """A fixed pool of daemon threads executing queued calls in the background.
+
+    The queue is bounded by max_queue so that a flood of work is refused (with
+    QueueFull) rather than allowed to consume unbounded memory. Exceptions
+    raised by calls are logged and counted.
+    """
+
+    def __init__(self, workers=4, max_queue=100, name='worker'):
+        self.name = name
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.discarded = 0
+        self.closing = threading.Event()
+        self.stopped = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._run, name='%s-%d' % (name, i))
+            for i in range(workers)
+            ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be called by a worker, raising
+        QueueFull if the queue is full."""
+        if self.closing.is_set():
+            raise QueueFull('%s pool is closed' % self.name)
+        self.queue.put_nowait((func, args, kwargs))
+
+    def full(self):
+        return self.closing.is_set() or self.queue.full()
+
+    def close(self, timeout=5):
+        """Stop accepting calls and wait up to timeout seconds for the workers
+        to finish those already queued. Calls which haven't started by then
+        are discarded (and logged)."""
+        self.closing.set()
+        deadline = time.time() + timeout
+        # Queue a sentinel for each worker behind the queued calls; if the
+        # queue is full this waits for the workers to make room
+        for thread in self.threads:
+            try:
+                self.queue.put(None, True, max(0, deadline - time.time()))
+            except QueueFull:
+                break
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        self.stopped.set()
+        discarded = 0
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.queue.task_done()
+            if item is not None:
+                discarded += 1
+        self._discard(discarded)
+        # Wake any worker still busy with a call when it next waits
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except QueueFull:
+                break
+
+    def stats(self):
+        """Return a dict of the pool's queue depth and counters."""
+        with self.lock:
+            return {
+                'workers':   len(self.threads),
+                'depth':     self.queue.qsize(),
+                'capacity':  self.queue.maxsize,
+                'processed': self.processed,
+                'failed':    self.failed,
+                'discarded': self.discarded,
+                }
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            if self.stopped.is_set():
+                self.queue.task_done()
+                self._discard(1)
+                break
+            func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logging.exception('Error in %s pool', self.name)
+                with self.lock:
+                    self.failed += 1
+            with self.lock:
+                self.processed += 1
+            self.queue.task_done()
+
+    def _discard(self, count):
+        if count:
+            logging.warning(
+                'Discarded %d queued calls closing %s pool', count, self.name)
+            with self.lock:
+                self.discarded += count
+
+
+class SerialQueues(object):
+    """Runs the calls submitted under each key one at a time, in the order
+    they were submitted, on a WorkerPool. Calls under different keys run in
+    parallel.
+
+    Calls waiting behind another call with the same key are held here rather
+    than in the pool's queue; no more than max_backlog may wait before submit
+    raises QueueFull.
+    """
+
+    def __init__(self, pool, max_backlog=100):
+        self.pool = pool
+        self.max_backlog = max_backlog
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.backlog = 0
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be called after the calls already
+        submitted under key, raising QueueFull if the backlog or the pool's
+        queue is full."""
+        with self.lock:
+            if self.backlog >= self.max_backlog:
+                raise QueueFull('%s backlog is full' % self.pool.name)
+            queue = self.queues.get(key)
+            if queue is None:
+                self.pool.submit(self._drain, key)
+                queue = self.queues[key] = deque()
+            queue.append((func, args, kwargs))
+            self.backlog += 1
+
+    def full(self):
+        with self.lock:
+            return self.backlog >= self.max_backlog or self.pool.full()
+
+    def stats(self):
+        """Return a dict of the number of keys with calls waiting or running
+        and the number of calls waiting."""
+        with self.lock:
+            return {
+                'keys':     len(self.queues),
+                'backlog':  self.backlog,
+                'capacity': self.max_backlog,
+                }
+
+    def _drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                func, args, kwargs = queue.popleft()
+                self.backlog -= 1
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logging.exception('Error in %s pool', self.pool.name)
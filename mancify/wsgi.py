@@ -9,20 +9,27 @@ from __future__ import (
 str = type('')
 
 import re
+import json
+import hashlib
 import logging
 import socket
 import threading
 import time
+from collections import OrderedDict
 
 from paramiko import SSHClient, AutoAddPolicy, SSHException
 from wheezy.routing import PathRouter, url
 from webob import Request, Response, exc
 from clockwork import clockwork
 
-from mancify import translator
+from mancify import translator, tagger, dialects
+from mancify.cache import ResultCache
 from mancify.dialects import manc
-from mancify.sms import MancifySMSService
+from mancify.sms import MancifySMSService, SMSDispatcher, SMS_LIMIT
 from mancify.ssh import MancifySSHSession
+from mancify.stats import TranslationStats, StatsAggregator
+from mancify.workers import WorkerPool, SerialQueues, QueueFull
+from mancify.state import get_state
 
 # Maximum length of an SMS message (with triple concatenation, the maximum
 # permitted under GSM)
@@ -32,48 +39,177 @@ SMS_MAX_LENGTH = 459
 class MancifyWsgiApp(object):
     def __init__(self, **kwargs):
         super(MancifyWsgiApp, self).__init__()
-        self.sms = MancifySMSService(kwargs['clockwork_api_key'])
+        # Replies are queued and sent in batches by a pool of background
+        # threads, and are cut short beyond sms_limit characters (0 for no
+        # limit)
+        self.sms = SMSDispatcher(
+            MancifySMSService(
+                kwargs['clockwork_api_key'],
+                kwargs.get('sms_limit', SMS_LIMIT) or None),
+            kwargs.get('sms_workers', 2), kwargs.get('sms_queue_size', 1000),
+            retries=kwargs.get('sms_retries', 3))
         self.exec_timeout = kwargs.get('exec_timeout', 10)
         self.connect_timeout = kwargs.get('connect_timeout', 30)
         self.session_timeout = kwargs.get('session_timeout', 300)
+        # If non-zero, the least recently used session is closed to make room
+        # for a new one once there are this many
+        self.max_sessions = kwargs.get('max_sessions', 0)
         self.output_limit = kwargs.get('output_limit', 1024)
+        self.phoneme_cache_size = kwargs.get('phoneme_cache_size', 10000)
+        translator.phoneme_cache.resize(self.phoneme_cache_size)
+        # Without a tagger the default (from MANCIFY_TAGGER) is left alone
+        if kwargs.get('tagger'):
+            tagger.default_backend = kwargs['tagger']
+        if kwargs.get('preload', True):
+            translator.preload()
+        # Totals of the per-stage statistics of all translations, if enabled
+        self.stats = StatsAggregator() if kwargs.get('stats', False) else None
+        # Whole translations of messages, if repeats are to be answered from
+        # the cache rather than with a fresh (randomly varied) translation
+        self.result_cache = None
+        if kwargs.get('result_cache', False):
+            self.result_cache = ResultCache(
+                kwargs.get('result_cache_size', 1000),
+                kwargs.get('result_cache_bytes', 1048576),
+                kwargs.get('result_cache_ttl', 3600))
+        # Messages are acknowledged as soon as they're queued and processed by
+        # a pool of background workers
+        self.workers = WorkerPool(
+            kwargs.get('workers', 4), kwargs.get('queue_size', 100), 'message')
+        # SSH commands, which may wait on slow hosts, have their own pool so
+        # they can't hold up translations. Each recipient's commands are run
+        # one at a time, in order
+        self.ssh_workers = WorkerPool(
+            kwargs.get('ssh_workers', 4), kwargs.get('ssh_queue_size', 100),
+            'ssh')
+        self.ssh_queues = SerialQueues(
+            self.ssh_workers, kwargs.get('ssh_queue_size', 100))
         self.router = PathRouter()
         self.router.add_routes([
             url('/',          self.do_index),
             url('/ssh',       self.do_ssh),
             url('/translate', self.do_translate),
+            url('/stats',     self.do_stats),
             ])
         self.lock = threading.Lock()
-        self.sessions = {}
-        self.messages = set()
+        # Held while checking for room in a queue, recording a message and
+        # queueing it, apart from self.lock as recording may wait on a write
+        # to the shared state database
+        self.queue_lock = threading.Lock()
+        self.reap_cond = threading.Condition(self.lock)
+        # Maps recipients to sessions in the order they were last used, which
+        # (as they share a timeout) is also the order in which they expire
+        self.sessions = OrderedDict()
+        # Recipients with a command running. A session which expires or is
+        # evicted while in use is closed once the command finishes
+        self.busy = set()
+        # The ids of messages already received, remembered for the SMS
+        # gateway's retry window, and the owners of SSH sessions. If a state
+        # database is given these are shared with other processes
+        self.state = get_state(
+            kwargs.get('state_db'),
+            kwargs.get('dedup_ttl', 86400), kwargs.get('dedup_size', 100000),
+            kwargs.get('dedup_error_rate', 0))
         self.terminate = threading.Event()
         self.reap_thread = threading.Thread(target=self.reap_sessions)
         self.reap_thread.daemon = True
         self.reap_thread.start()
+        self.forward_thread = None
+        if self.state.shared:
+            self.forward_thread = threading.Thread(target=self.poll_forwarded)
+            self.forward_thread.daemon = True
+            self.forward_thread.start()
 
     def close(self):
-        self.terminate.set()
+        with self.lock:
+            self.terminate.set()
+            self.reap_cond.notify()
+        self.workers.close()
+        self.ssh_workers.close()
+        self.sms.close()
         self.reap_thread.join(5)
+        if self.forward_thread:
+            self.forward_thread.join(5)
+        self.state.close()
 
     def reap_sessions(self):
         while True:
             reap_list = []
-            now = time.time()
             with self.lock:
-                for recipient, session in self.sessions.iteritems():
-                    if not session.timestamp:
-                        reap_list.append((recipient, session))
-                    if (now - session.timestamp) > self.session_timeout:
-                        reap_list.append((recipient, session))
-                for recipient, session in reap_list:
-                    try:
-                        session.close(quiet=True)
-                    finally:
-                        del self.sessions[recipient]
-                        session = None
-            if self.terminate.wait(10):
+                while not self.terminate.is_set():
+                    now = time.time()
+                    timeout = None
+                    while self.sessions:
+                        recipient = next(iter(self.sessions))
+                        session = self.sessions[recipient]
+                        if session.timestamp:
+                            timeout = (
+                                session.timestamp + self.session_timeout - now)
+                            if timeout > 0:
+                                break
+                        session = self.sessions.pop(recipient)
+                        if recipient not in self.busy:
+                            reap_list.append((recipient, session))
+                    if reap_list:
+                        break
+                    # Sleep until the oldest session expires, or a new one is
+                    # added if there are none
+                    self.reap_cond.wait(timeout)
+            # Closing a session can be slow, so do so without the lock
+            for recipient, session in reap_list:
+                self.close_session(recipient, session)
+            if self.terminate.is_set():
                 break
 
+    def close_session(self, recipient, session, used=None):
+        # used is the time the session was last used, if it was closed by
+        # the user
+        if used is None:
+            used = session.timestamp
+        try:
+            session.close(quiet=True)
+        except Exception:
+            logging.exception('Error closing session for %s', recipient)
+        with self.lock:
+            # If a new session was started for the recipient while this one
+            # was closing, it keeps ownership
+            if recipient in self.sessions or recipient in self.busy:
+                return
+        # The state is checked too in case one starts in the meantime
+        self.state.release_session(recipient, used)
+
+    def poll_forwarded(self):
+        # Queue the messages for SSH sessions owned by this process that
+        # were received by other processes. Those which don't fit in the
+        # queue wait in the state database for a later poll
+        while not self.terminate.wait(0.25):
+            self.state.take_forwarded(self.submit_forwarded)
+
+    def submit_forwarded(self, sender, recipient, content):
+        with self.queue_lock:
+            self.ssh_queues.submit(
+                recipient, self.process_ssh, sender, recipient, content)
+
+    def translate(self, content, dialect):
+        if self.result_cache is None:
+            return self._translate(content, dialect)
+        key = (
+            dialects.compiled(dialect).name,
+            hashlib.sha1(content.encode('utf-8')).digest())
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self._translate(content, dialect)
+            self.result_cache.set(key, result)
+        return result
+
+    def _translate(self, content, dialect):
+        if self.stats is None:
+            return translator.translate(content, dialect)
+        stats = TranslationStats()
+        result = translator.translate(content, dialect, stats=stats)
+        self.stats.add(stats)
+        return result
+
     def __call__(self, environ, start_response):
         req = Request(environ)
         try:
@@ -109,6 +245,41 @@ class MancifyWsgiApp(object):
 """
         return resp
 
+    def do_stats(self, req):
+        resp = Response()
+        resp.content_type = b'application/json'
+        resp.body = json.dumps({
+            'translations':  self.stats.as_dict() if self.stats else None,
+            'phoneme_cache': translator.phoneme_cache.stats(),
+            'result_cache':  (
+                self.result_cache.stats()
+                if self.result_cache is not None else None),
+            'queue':         self.workers.stats(),
+            'ssh':           dict(
+                self.ssh_workers.stats(), **self.ssh_queues.stats()),
+            'sms':           self.sms.stats(),
+            }, sort_keys=True).encode('utf-8')
+        return resp
+
+    def enqueue(self, msg_id, executor, *args):
+        # Queue the message by calling executor.submit(*args)
+        with self.queue_lock:
+            # Don't record the message if it can't be queued so that it's
+            # accepted when the server retries
+            if executor.full():
+                raise exc.HTTPServiceUnavailable('Message queue is full')
+            # If we've seen the message before it's a duplicate. Return 200 OK
+            # so the server doesn't keep retrying but otherwise ignore it
+            if not self.state.claim_message(msg_id):
+                raise exc.HTTPOk('Message already processed')
+            try:
+                executor.submit(*args)
+            except QueueFull:
+                # The pool is closing
+                self.state.release_message(msg_id)
+                raise exc.HTTPServiceUnavailable('Message queue is closed')
+        raise exc.HTTPOk('Message queued')
+
     def do_translate(self, req):
         # Check the request has the required parameters
         if not 'msg_id' in req.params:
@@ -121,13 +292,12 @@ class MancifyWsgiApp(object):
         recipient = req.params['from']
         sender = req.params['to']
         content = req.params['content']
-        # If we've seen the message before it's a duplicate. Return 200 OK so
-        # the server doesn't keep retrying but otherwise ignore it
-        if msg_id in self.messages:
-            raise exc.HTTPOk('Message already processed')
-        self.messages.add(msg_id)
-        self.sms.send(sender, recipient, translator.translate(content, manc))
-        raise exc.HTTPOk('Message processed')
+        self.enqueue(
+            msg_id, self.workers,
+            self.process_translate, sender, recipient, content)
+
+    def process_translate(self, sender, recipient, content):
+        self.sms.send(sender, recipient, self.translate(content, manc))
 
     def do_ssh(self, req):
         # Check the request has the required parameters
@@ -141,26 +311,72 @@ class MancifyWsgiApp(object):
         recipient = req.params['from']
         sender = req.params['to']
         content = req.params['content']
-        # If we've seen the message before it's a duplicate. Return 200 OK so
-        # the server doesn't keep retrying but otherwise ignore it
-        if msg_id in self.messages:
-            raise exc.HTTPOk('Message already processed')
-        self.messages.add(msg_id)
+        self.enqueue(
+            msg_id, self.ssh_queues,
+            recipient, self.process_ssh, sender, recipient, content)
+
+    def process_ssh(self, sender, recipient, content):
+        session = None
+        used = None
+        evicted = None
+        with self.lock:
+            self.busy.add(recipient)
         try:
+            with self.lock:
+                session = self.sessions.get(recipient)
+            if session is None:
+                owner = self.state.claim_session(recipient, self.session_timeout)
+                if owner != self.state.owner:
+                    # Another process holds the connection; pass the message
+                    # on to it
+                    self.state.forward(owner, sender, recipient, content)
+                    return
+            else:
+                self.state.touch_session(recipient)
             with self.lock:
                 try:
-                    session = self.sessions[recipient]
+                    # Re-insert the session to move it to the end of the
+                    # expiry order
+                    session = self.sessions.pop(recipient)
                 except KeyError:
                     session = MancifySSHSession(
                         self.sms, sender, recipient,
-                        self.connect_timeout, self.exec_timeout)
-                    self.sessions[recipient] = session
-                session.timestamp = time.time()
+                        self.connect_timeout, self.exec_timeout,
+                        self.translate, output_limit=self.output_limit)
+                    if self.max_sessions and len(self.sessions) >= self.max_sessions:
+                        evicted = self.evict_session()
+                    self.reap_cond.notify()
+                session.timestamp = used = time.time()
+                self.sessions[recipient] = session
+            if evicted:
+                self.close_session(*evicted)
             session.execute(content)
         except Exception as e:
             msg = str(e)
             if len(msg) > 140:
                 msg = msg[:137] + '...'
             self.sms.send(sender, recipient, msg)
-        raise exc.HTTPOk('Message processed')
+        finally:
+            with self.lock:
+                self.busy.discard(recipient)
+                current = self.sessions.get(recipient)
+                if (
+                        session is not None and current is session and
+                        not session.timestamp):
+                    # The session was closed by the user
+                    del self.sessions[recipient]
+                    current = None
+            if session is not None and current is not session:
+                # The session was closed by the user, or expired or was
+                # evicted while the command ran
+                self.close_session(recipient, session, used)
 
+    def evict_session(self):
+        # Remove the least recently used session which isn't running a
+        # command, returning it to be closed. If all of them are, the least
+        # recently used is removed and closed once its command finishes
+        for recipient in self.sessions:
+            if recipient not in self.busy:
+                return recipient, self.sessions.pop(recipient)
+        self.sessions.popitem(last=False)
+        return None
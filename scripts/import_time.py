@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Measure how long it takes to import the translator and to load its heavy
+resources, each in a fresh interpreter so nothing is already cached.
+
+    python scripts/import_time.py [repeat]
+"""
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+import sys
+import subprocess
+
+STATEMENTS = [
+    ('import mancify.translator', 'import mancify.translator'),
+    ('translate (normal dialect)',
+        'from mancify import translator; from mancify.dialects import normal; '
+        'translator.translate("hello world", normal)'),
+    ('preload()', 'from mancify import translator; translator.preload()'),
+    ]
+
+SCRIPT = """\
+import time
+start = time.time()
+%s
+print(time.time() - start)
+"""
+
+
+def measure(statement):
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT % statement])
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for label, statement in STATEMENTS:
+        timings = [measure(statement) for i in range(repeat)]
+        print('%-30s best of %d: %.3fs' % (label, repeat, min(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Compare the speed and tag agreement of the lexicon tagger backend with NLTK's
+tagger on held-out sentences of NLTK's treebank corpus.
+
+    python scripts/tagger_benchmark.py [held-out fraction]
+
+The lexicon is trained on the remaining sentences. Agreement is reported both
+for exact tags and for the coarse classes the manc structure rules match on
+(JJ*, NN*, single character punctuation and everything else).
+"""
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    division,
+    print_function,
+    )
+
+import re
+import sys
+import time
+
+from nltk.corpus import treebank
+
+from mancify.tagger import NLTKTagger, LexiconTagger
+
+
+def coarse(tag):
+    if tag.startswith('JJ'):
+        return 'JJ'
+    elif tag.startswith('NN'):
+        return 'NN'
+    elif re.match('^.$', tag):
+        return '.'
+    return 'other'
+
+
+def timed(tagger, sentences):
+    start = time.time()
+    result = tagger.tag_many(sentences)
+    return result, time.time() - start
+
+
+def agreement(tagged_a, tagged_b, key=lambda tag: tag):
+    pairs = [
+        (key(tag_a), key(tag_b))
+        for sent_a, sent_b in zip(tagged_a, tagged_b)
+        for (word_a, tag_a), (word_b, tag_b) in zip(sent_a, sent_b)
+        ]
+    return sum(a == b for a, b in pairs) / len(pairs)
+
+
+def main():
+    held_out = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    sentences = [
+        [(word, tag) for word, tag in sentence if tag != '-NONE-']
+        for sentence in treebank.tagged_sents()
+        ]
+    split = int(len(sentences) * (1 - held_out))
+    train, test = sentences[:split], sentences[split:]
+    tokens = [[word for word, tag in sentence] for sentence in test]
+    words = sum(len(sentence) for sentence in tokens)
+
+    nltk_tagger = NLTKTagger()
+    nltk_tagger.tag(['warm', 'up'])
+    lexicon_tagger = LexiconTagger.train(train)
+    nltk_tags, nltk_time = timed(nltk_tagger, tokens)
+    lexicon_tags, lexicon_time = timed(lexicon_tagger, tokens)
+
+    print('%d sentences, %d words held out' % (len(tokens), words))
+    print('%-10s %12s %10s %10s' % ('backend', 'words/s', 'gold', 'coarse'))
+    for name, tags, elapsed in (
+            ('nltk', nltk_tags, nltk_time),
+            ('lexicon', lexicon_tags, lexicon_time)):
+        print('%-10s %12.0f %9.1f%% %9.1f%%' % (
+            name, words / elapsed,
+            agreement(tags, test) * 100,
+            agreement(tags, test, coarse) * 100))
+    print('lexicon agreement with nltk: %.1f%% exact, %.1f%% coarse' % (
+        agreement(lexicon_tags, nltk_tags) * 100,
+        agreement(lexicon_tags, nltk_tags, coarse) * 100))
+    print('lexicon speed up: %.1fx' % (nltk_time / lexicon_time))
+
+
+if __name__ == '__main__':
+    main()